@@ -0,0 +1,76 @@
+import asyncio
+import json
+from typing import Any, List, Optional, Tuple
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class ASGIWebSocket:
+    def __init__(self, app, path: str, query_string: str = '',
+                 headers: Optional[List[Tuple[str, str]]] = None,
+                 subprotocols: Optional[List[str]] = None) -> None:
+        self.app = app
+        self.path = path
+        self.query_string = query_string
+        self.headers = headers or []
+        self.subprotocols = subprotocols or []
+        self.accepted_subprotocol: Optional[str] = None
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def _scope(self) -> dict:
+        headers = [(k.lower().encode(), v.encode()) for k, v in self.headers]
+        if self.subprotocols:
+            headers.append((b'sec-websocket-protocol', ', '.join(self.subprotocols).encode()))
+        return {
+            'type': 'websocket',
+            'asgi': {'version': '3.0'},
+            'scheme': 'ws',
+            'http_version': '1.1',
+            'path': self.path,
+            'raw_path': self.path.encode(),
+            'root_path': '',
+            'query_string': self.query_string.encode(),
+            'headers': headers,
+            'client': ('127.0.0.1', 50000),
+            'server': ('bench', 80),
+            'subprotocols': self.subprotocols,
+        }
+
+    async def connect(self) -> None:
+        self._task = asyncio.create_task(self.app(self._scope(), self._to_app.get, self._from_app.put))
+        await self._to_app.put({'type': 'websocket.connect'})
+        message = await self._from_app.get()
+        if message['type'] != 'websocket.accept':
+            raise WebSocketClosed(message)
+        self.accepted_subprotocol = message.get('subprotocol')
+
+    async def send_text(self, text: str) -> None:
+        await self._to_app.put({'type': 'websocket.receive', 'text': text})
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self._to_app.put({'type': 'websocket.receive', 'bytes': data})
+
+    async def send_json(self, payload: Any) -> None:
+        await self.send_text(json.dumps(payload))
+
+    async def receive(self) -> dict:
+        message = await self._from_app.get()
+        if message['type'] == 'websocket.close':
+            raise WebSocketClosed(message)
+        return message
+
+    async def receive_json(self) -> Any:
+        message = await self.receive()
+        return json.loads(message['text'] if message.get('text') is not None else message['bytes'])
+
+    async def close(self) -> None:
+        await self._to_app.put({'type': 'websocket.disconnect', 'code': 1000})
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=5)
+            except (asyncio.TimeoutError, Exception):
+                self._task.cancel()
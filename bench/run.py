@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+import msgpack
+from sqlalchemy import create_engine, event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mysite.database import db as database
+from mysite.database.models import Base, UserProfile, ChatGroup, GroupPeople, ChatMessage
+from mysite.api.auth import create_access_token
+from bench.asgi_ws import ASGIWebSocket, WebSocketClosed
+
+DEFAULT_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'chat_bench.db')
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+WS_OPS = {'send_message': 5, 'fetch_messages': 3, 'list_groups': 2}
+REST_PATHS = ['/group/', '/group/{group_id}', '/group/owner/{user_id}', '/people/group/{group_id}',
+              '/user/{user_id}', '/message/{message_id}']
+
+
+class QueryCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, *args) -> None:
+        self.count += 1
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.fanout: List[float] = []
+        self.errors: Dict[str, int] = defaultdict(int)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float], duration: float) -> dict:
+    return {
+        'count': len(values),
+        'throughput': round(len(values) / duration, 2),
+        'p50_ms': round(percentile(values, 50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 3) if values else None,
+    }
+
+
+def configure_database(db_url: str):
+    if db_url.startswith('sqlite'):
+        # ws actions run their queries in worker threads, so use a file database with one
+        # connection per thread rather than a shared in-memory connection
+        engine = create_engine(db_url, connect_args={'check_same_thread': False, 'timeout': 30},
+                               pool_size=20, max_overflow=20)
+        event.listen(engine, 'connect', lambda conn, record: conn.execute('PRAGMA journal_mode=WAL'))
+    else:
+        engine = create_engine(db_url)
+    database.SessionLocal.configure(bind=engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def seed(args) -> dict:
+    rnd = random.Random(args.seed)
+    db = database.SessionLocal()
+    try:
+        users = [UserProfile(username=f'bench{i}', email=f'bench{i}@example.com', password='bench')
+                 for i in range(args.clients)]
+        db.add_all(users)
+        db.flush()
+
+        groups = [ChatGroup(name=f'group{g}', owner_id=users[g % len(users)].id) for g in range(args.groups)]
+        db.add_all(groups)
+        db.flush()
+
+        memberships: Dict[int, List[int]] = defaultdict(list)
+        for user in users:
+            for group in rnd.sample(groups, min(args.groups_per_user, len(groups))):
+                memberships[user.id].append(group.id)
+                db.add(GroupPeople(group_id=group.id, user_id=user.id))
+        db.flush()
+
+        message_ids = []
+        for group in groups:
+            members = [uid for uid, gids in memberships.items() if group.id in gids] or [group.owner_id]
+            for n in range(args.seed_messages):
+                message = ChatMessage(group_id=group.id, user_id=rnd.choice(members), text=f'seed {n}')
+                db.add(message)
+                message_ids.append(message)
+        db.commit()
+
+        return {
+            'users': [(u.id, u.username) for u in users],
+            'groups': [g.id for g in groups],
+            'memberships': dict(memberships),
+            'messages': [m.id for m in message_ids],
+        }
+    finally:
+        db.close()
+
+
+class BenchClient:
+    def __init__(self, app, user_id: int, username: str, group_ids: List[int], stats: Stats,
+                 protocol: str = 'json', batch: bool = False) -> None:
+        self.user_id = user_id
+        self.group_ids = group_ids
+        self.stats = stats
+        self.protocol = protocol
+        query = f'token={create_access_token({"sub": username})}' + ('&batch=true' if batch else '')
+        self.ws = ASGIWebSocket(app, '/ws/chat', query, subprotocols=[protocol])
+        self._waiter: Optional[asyncio.Future] = None
+        self._waiting_for: Optional[str] = None
+        self._nonce = 0
+        self._reader: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self.ws.connect()
+        await self.receive()
+        self._reader = asyncio.create_task(self._read())
+
+    async def send(self, payload: dict) -> None:
+        if self.protocol == 'msgpack':
+            await self.ws.send_bytes(msgpack.packb(payload, use_bin_type=True))
+        else:
+            await self.ws.send_json(payload)
+
+    async def receive(self) -> dict:
+        if self.protocol == 'msgpack':
+            return msgpack.unpackb((await self.ws.receive())['bytes'], raw=False)
+        return await self.ws.receive_json()
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                payload = await self.receive()
+                for item in payload['items'] if payload.get('event') == 'batch' else [payload]:
+                    self._dispatch(item)
+        except (WebSocketClosed, asyncio.CancelledError):
+            pass
+
+    def _dispatch(self, payload: dict) -> None:
+        key = payload.get('event')
+        if key == 'message':
+            parts = payload['message']['text'].split()
+            if len(parts) == 3 and parts[0] == 'bench':
+                self.stats.fanout.append(time.perf_counter() - float(parts[2]))
+                if payload['message']['user_id'] == self.user_id:
+                    key = f'message:{parts[1]}'
+        if self._waiter is not None and not self._waiter.done() and key in (self._waiting_for, 'error'):
+            self._waiter.set_result(payload)
+
+    async def request(self, payload: dict, expect: str) -> dict:
+        self._waiter = asyncio.get_running_loop().create_future()
+        self._waiting_for = expect
+        await self.send(payload)
+        return await asyncio.wait_for(self._waiter, timeout=30)
+
+    async def run_op(self, op: str, rnd: random.Random) -> None:
+        group_id = rnd.choice(self.group_ids)
+        started = time.perf_counter()
+        if op == 'send_message':
+            self._nonce += 1
+            nonce = f'{self.user_id}-{self._nonce}'
+            result = await self.request({'action': 'send_message', 'group_id': group_id,
+                                         'text': f'bench {nonce} {time.perf_counter()}'}, f'message:{nonce}')
+        elif op == 'fetch_messages':
+            result = await self.request({'action': 'fetch_messages', 'group_id': group_id, 'limit': 50},
+                                        'messages')
+        else:
+            result = await self.request({'action': 'list_groups'}, 'groups')
+
+        if result.get('event') == 'error':
+            self.stats.errors[op] += 1
+        else:
+            self.stats.latencies[op].append(time.perf_counter() - started)
+
+    async def close(self) -> None:
+        await self.ws.close()
+        if self._reader is not None:
+            self._reader.cancel()
+
+
+def pick_op(rnd: random.Random) -> str:
+    return rnd.choices(list(WS_OPS), weights=list(WS_OPS.values()))[0]
+
+
+async def ws_worker(client: BenchClient, deadline: float, seed: int) -> None:
+    rnd = random.Random(seed)
+    while time.perf_counter() < deadline:
+        try:
+            await client.run_op(pick_op(rnd), rnd)
+        except asyncio.TimeoutError:
+            client.stats.errors['timeout'] += 1
+
+
+def rest_url(path: str, rnd: random.Random, data: dict) -> str:
+    return path.format(group_id=rnd.choice(data['groups']), user_id=rnd.choice(data['users'])[0],
+                       message_id=rnd.choice(data['messages']))
+
+
+async def rest_worker(http: httpx.AsyncClient, data: dict, stats: Stats, deadline: float, seed: int) -> None:
+    rnd = random.Random(seed)
+    while time.perf_counter() < deadline:
+        path = rnd.choice(REST_PATHS)
+        started = time.perf_counter()
+        response = await http.get(rest_url(path, rnd, data))
+        if response.status_code >= 400:
+            stats.errors[f'GET {path}'] += 1
+        else:
+            stats.latencies[f'GET {path}'].append(time.perf_counter() - started)
+        # the in-process transport never blocks on a socket, so yield to the WebSocket tasks
+        await asyncio.sleep(0)
+
+
+async def profile_queries(app, data: dict, counter: QueryCounter, args) -> Dict[str, float]:
+    rnd = random.Random(0)
+    user_id, username = data['users'][0]
+    client = BenchClient(app, user_id, username, data['memberships'][user_id], Stats(), args.protocol, args.batch)
+    await client.start()
+    profile = {}
+    try:
+        for op in WS_OPS:
+            before = counter.count
+            for _ in range(5):
+                await client.run_op(op, rnd)
+            profile[op] = (counter.count - before) / 5
+    finally:
+        await client.close()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as http:
+        for path in REST_PATHS:
+            before = counter.count
+            await http.get(rest_url(path, rnd, data))
+            profile[f'GET {path}'] = counter.count - before
+    return profile
+
+
+async def run(args) -> dict:
+    engine = configure_database(args.db_url)
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+
+    from main import chat_app
+
+    data = seed(args)
+    queries_per_op = await profile_queries(chat_app, data, counter, args)
+
+    stats = Stats()
+    clients = [BenchClient(chat_app, uid, name, data['memberships'][uid], stats, args.protocol, args.batch)
+               for uid, name in data['users'][:args.clients]]
+    connect_started = time.perf_counter()
+    await asyncio.gather(*(c.start() for c in clients))
+    connect_time = time.perf_counter() - connect_started
+
+    queries_before = counter.count
+    started = time.perf_counter()
+    deadline = started + args.duration
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=chat_app), base_url='http://bench') as http:
+        await asyncio.gather(
+            *(ws_worker(c, deadline, args.seed + i) for i, c in enumerate(clients)),
+            *(rest_worker(http, data, stats, deadline, args.seed + 10000 + i) for i in range(args.rest_workers)),
+        )
+    elapsed = time.perf_counter() - started
+    queries = counter.count - queries_before
+
+    await asyncio.gather(*(c.close() for c in clients))
+    Base.metadata.drop_all(engine)
+
+    ops = {op: summarize(values, elapsed) for op, values in sorted(stats.latencies.items())}
+    total_ops = sum(len(v) for v in stats.latencies.values())
+    return {
+        'config': {k: getattr(args, k) for k in ('clients', 'groups', 'groups_per_user', 'seed_messages',
+                                                  'duration', 'rest_workers', 'seed', 'protocol', 'batch')},
+        'backend': 'sqlite' if args.db_url.startswith('sqlite') else 'postgres',
+        'connect_seconds': round(connect_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput': round(total_ops / elapsed, 2),
+        'ops': ops,
+        'fanout': summarize(stats.fanout, elapsed),
+        'db': {'queries': queries, 'queries_per_second': round(queries / elapsed, 2),
+               'queries_per_op': round(queries / total_ops, 3) if total_ops else None},
+        'queries_per_op': queries_per_op,
+        'errors': dict(stats.errors),
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    if baseline.get('config') != report['config']:
+        print('warning: baseline was recorded with a different configuration')
+
+    def check_higher_is_better(name, current, previous):
+        if current is not None and previous and current < previous * (1 - tolerance):
+            regressions.append(f'{name}: {current} < {previous} (baseline)')
+
+    def check_lower_is_better(name, current, previous):
+        if current is not None and previous and current > previous * (1 + tolerance):
+            regressions.append(f'{name}: {current} > {previous} (baseline)')
+
+    check_higher_is_better('throughput', report['throughput'], baseline.get('throughput'))
+    check_lower_is_better('fanout p95_ms', report['fanout']['p95_ms'], baseline.get('fanout', {}).get('p95_ms'))
+    for op, summary in report['ops'].items():
+        previous = baseline.get('ops', {}).get(op, {})
+        check_higher_is_better(f'{op} throughput', summary['throughput'], previous.get('throughput'))
+        check_lower_is_better(f'{op} p95_ms', summary['p95_ms'], previous.get('p95_ms'))
+    for op, count in report['queries_per_op'].items():
+        previous = baseline.get('queries_per_op', {}).get(op)
+        if previous is not None and count > previous:
+            regressions.append(f'{op} queries: {count} > {previous} (baseline)')
+    return regressions
+
+
+def print_report(report: dict) -> None:
+    print(f"backend={report['backend']} clients={report['config']['clients']} "
+          f"elapsed={report['elapsed_seconds']}s connect={report['connect_seconds']}s")
+    print(f"total throughput: {report['throughput']} ops/s")
+    print(f"{'operation':32} {'count':>8} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'queries':>8}")
+    rows = list(report['ops'].items()) + [('fan-out delivery', report['fanout'])]
+    for op, s in rows:
+        queries = report['queries_per_op'].get(op, '')
+        print(f"{op:32} {s['count']:>8} {s['throughput']:>10} {str(s['p50_ms']):>10} "
+              f"{str(s['p95_ms']):>10} {str(s['p99_ms']):>10} {str(queries):>8}")
+    print(f"db: {report['db']['queries']} queries, {report['db']['queries_per_second']}/s, "
+          f"{report['db']['queries_per_op']} per op")
+    if report['errors']:
+        print(f"errors: {report['errors']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='WebSocket and REST load benchmark for chat_app')
+    parser.add_argument('--db-url', default=os.getenv('BENCH_DB_URL', f'sqlite:///{DEFAULT_SQLITE_PATH}'),
+                        help='database to benchmark against; tables are dropped and recreated')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--groups-per-user', type=int, default=2)
+    parser.add_argument('--seed-messages', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rest-workers', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json',
+                        help='WebSocket subprotocol the clients negotiate')
+    parser.add_argument('--batch', action='store_true', help='clients opt in to coalesced event frames')
+    parser.add_argument('--baseline', default=None, help='baseline name under bench/baselines')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--json', dest='json_path', default=None, help='write the full report to this file')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{args.baseline or report['backend']}.json")
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline saved to {baseline_path}')
+        return 0
+
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print('regressions against baseline:')
+            for line in regressions:
+                print(f'  {line}')
+            return 1
+        print('no regressions against baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
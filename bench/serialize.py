@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from mysite.database.db import Base
+from mysite.database.models import UserProfile, ChatGroup, ChatMessage
+from mysite.database.schema import ChatMessageOutSchema
+from mysite.serialize import list_adapter, schema_columns, rows_response
+
+
+def seed(session, rows: int) -> None:
+    user = UserProfile(username='bench', email='bench@example.com', password='x')
+    session.add(user)
+    session.flush()
+    group = ChatGroup(name='bench', owner_id=user.id)
+    session.add(group)
+    session.flush()
+    started = datetime.utcnow() - timedelta(days=1)
+    session.bulk_insert_mappings(ChatMessage, [
+        {'group_id': group.id, 'user_id': user.id, 'text': f'message {i} ' + 'x' * 40,
+         'created_date': started + timedelta(seconds=i), 'updated_date': started, 'version': 1}
+        for i in range(rows)
+    ])
+    session.commit()
+
+
+def response_model_path(session) -> bytes:
+    # what FastAPI does for `return db.query(Model).all()` with response_model=List[Schema]
+    field = create_model_field('response', List[ChatMessageOutSchema], mode='serialization')
+    objects = session.query(ChatMessage).all()
+    content = asyncio.run(serialize_response(field=field, response_content=objects))
+    return JSONResponse(content).body
+
+
+def type_adapter_path(session) -> bytes:
+    adapter = list_adapter(ChatMessageOutSchema)
+    rows = session.query(*schema_columns(ChatMessage, ChatMessageOutSchema)).all()
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+
+def orjson_rows_path(session) -> bytes:
+    rows = session.query(*schema_columns(ChatMessage, ChatMessageOutSchema)).all()
+    return rows_response(ChatMessageOutSchema, rows).body
+
+
+def orjson_objects_path(session) -> bytes:
+    field = create_model_field('response', List[ChatMessageOutSchema], mode='serialization')
+    objects = session.query(ChatMessage).all()
+    content = asyncio.run(serialize_response(field=field, response_content=objects))
+    return ORJSONResponse(content).body
+
+
+PATHS = {
+    'orm + response_model (before)': response_model_path,
+    'orm + response_model + orjson': orjson_objects_path,
+    'columns + TypeAdapter': type_adapter_path,
+    'columns + orjson (list endpoints)': orjson_rows_path,
+}
+
+
+def measure(fn: Callable, session_factory, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        session = session_factory()
+        try:
+            started = time.perf_counter()
+            fn(session)
+            timings.append(time.perf_counter() - started)
+        finally:
+            session.close()
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare list endpoint serialization paths')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    with session_factory() as session:
+        seed(session, args.rows)
+
+    baseline = None
+    print(f'{args.rows} messages, best of {args.repeat}')
+    for name, fn in PATHS.items():
+        elapsed = measure(fn, session_factory, args.repeat)
+        baseline = baseline or elapsed
+        print(f'{name:<36} {elapsed * 1000:9.2f} ms {baseline / elapsed:6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
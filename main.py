@@ -1,10 +1,32 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from mysite.api import user, group, chat_wb, auth, chat, message, people
-import uvicorn
+from fastapi.responses import ORJSONResponse
+from mysite.api import user, group, chat_wb, auth, chat, message, people, metrics, attachment
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
-from mysite.config import SECRET_KEY
+from mysite.config import SECRET_KEY, DB_POOL_PREWARM
+from mysite.database.db import engine, QueryCountMiddleware, prewarm_pool
+from mysite.database.routing import replicas
+from mysite.metrics import MetricsMiddleware, instrument_engine
+from mysite import server
+from mysite.bus import bus
 
-chat_app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for target in [engine, *replicas.engines]:
+        await run_in_threadpool(prewarm_pool, target, DB_POOL_PREWARM)
+    await bus.start()
+    yield
+    # runs after DrainingServer has moved the websockets off this worker
+    chat_wb.manager.close()
+    chat_wb.offline_queue.close()
+    await bus.stop()
+    for target in [engine, *replicas.engines]:
+        target.dispose()
+
+
+chat_app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 chat_app.include_router(auth.auth_router)
 chat_app.include_router(user.user_router)
 chat_app.include_router(group.group_router)
@@ -12,8 +34,15 @@ chat_app.include_router(chat_wb.chat_router)
 chat_app.include_router(chat.group_chat_router)
 chat_app.include_router(message.message_router)
 chat_app.include_router(people.people_router)
+chat_app.include_router(attachment.attachment_router)
+chat_app.include_router(metrics.metrics_router)
 chat_app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+chat_app.add_middleware(QueryCountMiddleware)
+chat_app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+for replica in replicas.engines:
+    instrument_engine(replica)
 
 
 if __name__ == '__main__':
-    uvicorn.run(chat_app, host='127.0.0.1', port=8998)
\ No newline at end of file
+    server.main()
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""add attachments
+
+Revision ID: 27a421c8f263
+Revises: 4e84ddeb5f68
+Create Date: 2026-10-19 12:48:37.905312
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '27a421c8f263'
+down_revision: Union[str, Sequence[str], None] = '4e84ddeb5f68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('attachment',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('content_type', sa.String(length=255), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('uploader_id', sa.Integer(), nullable=True),
+    sa.Column('created_date', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['uploader_id'], ['profile.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('sha256')
+    )
+    op.add_column('message', sa.Column('attachment_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('message_attachment_id_fkey', 'message', 'attachment', ['attachment_id'], ['id'],
+                          ondelete='SET NULL')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('message_attachment_id_fkey', 'message', type_='foreignkey')
+    op.drop_column('message', 'attachment_id')
+    op.drop_table('attachment')
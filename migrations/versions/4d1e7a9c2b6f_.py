@@ -0,0 +1,37 @@
+"""add updated_date and version columns
+
+Revision ID: 4d1e7a9c2b6f
+Revises: e6f203636ea2
+Create Date: 2026-10-19 10:12:31.402917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4d1e7a9c2b6f'
+down_revision: Union[str, Sequence[str], None] = 'e6f203636ea2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+TABLES = ('profile', 'group', 'people', 'message')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table in TABLES:
+        op.add_column(table, sa.Column('updated_date', sa.DateTime(), nullable=False,
+                                       server_default=sa.func.now()))
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False,
+                                       server_default='1'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in TABLES:
+        op.drop_column(table, 'version')
+        op.drop_column(table, 'updated_date')
@@ -0,0 +1,61 @@
+"""cascade deletes in the database and tombstone groups
+
+Revision ID: 4e84ddeb5f68
+Revises: de38fe922756
+Create Date: 2026-10-19 12:05:19.640213
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e84ddeb5f68'
+down_revision: Union[str, Sequence[str], None] = 'de38fe922756'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (table, column, referenced table); constraint names are the PostgreSQL defaults
+FOREIGN_KEYS = (
+    ('group', 'owner_id', 'profile'),
+    ('refresh_token', 'user_id', 'profile'),
+    ('people', 'group_id', 'group'),
+    ('people', 'user_id', 'profile'),
+    ('message', 'group_id', 'group'),
+    ('message', 'user_id', 'profile'),
+)
+
+# the cascades look children up by these columns; message.group_id is covered by ix_message_group_id_id
+INDEXES = (
+    ('group', 'owner_id'),
+    ('refresh_token', 'user_id'),
+    ('people', 'group_id'),
+    ('people', 'user_id'),
+    ('message', 'user_id'),
+)
+
+
+def recreate_foreign_keys(ondelete: Union[str, None]) -> None:
+    for table, column, referred in FOREIGN_KEYS:
+        name = f'{table}_{column}_fkey'
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referred, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table, column in INDEXES:
+        op.create_index(f'ix_{table}_{column}', table, [column])
+    recreate_foreign_keys('CASCADE')
+    op.add_column('group', sa.Column('deleted_date', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('group', 'deleted_date')
+    recreate_foreign_keys(None)
+    for table, column in INDEXES:
+        op.drop_index(f'ix_{table}_{column}', table_name=table)
@@ -0,0 +1,33 @@
+"""add a default partition to message
+
+Revision ID: 5c0d2b7e91a4
+Revises: 27a421c8f263
+Create Date: 2026-10-19 14:21:05.448213
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from mysite.database.partitions import (DEFAULT_PARTITION, create_default_partition, create_partition,
+                                        default_months)
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0d2b7e91a4'
+down_revision: Union[str, Sequence[str], None] = '27a421c8f263'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    create_default_partition(op.get_bind())
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    conn = op.get_bind()
+    for month in default_months(conn):
+        create_partition(conn, month)
+    op.execute(f'DROP TABLE "{DEFAULT_PARTITION}"')
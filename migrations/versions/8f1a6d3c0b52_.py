@@ -0,0 +1,28 @@
+"""index message_idempotency.created_date
+
+Revision ID: 8f1a6d3c0b52
+Revises: 5c0d2b7e91a4
+Create Date: 2026-10-19 14:58:31.207694
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f1a6d3c0b52'
+down_revision: Union[str, Sequence[str], None] = '5c0d2b7e91a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_message_idempotency_created_date', 'message_idempotency', ['created_date'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_message_idempotency_created_date', table_name='message_idempotency')
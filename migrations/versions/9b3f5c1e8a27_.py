@@ -0,0 +1,72 @@
+"""partition message by created_date
+
+Revision ID: 9b3f5c1e8a27
+Revises: 4d1e7a9c2b6f
+Create Date: 2026-10-19 11:02:47.118530
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from mysite.database.partitions import ensure_partitions
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b3f5c1e8a27'
+down_revision: Union[str, Sequence[str], None] = '4d1e7a9c2b6f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+COLUMNS = 'id, group_id, user_id, text, created_date, updated_date, version'
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    conn = op.get_bind()
+    op.execute('ALTER TABLE message RENAME TO message_legacy')
+    op.execute('ALTER TABLE message_legacy RENAME CONSTRAINT message_pkey TO message_legacy_pkey')
+    op.execute("""
+        CREATE TABLE message (
+            id INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            group_id INTEGER NOT NULL REFERENCES "group" (id),
+            user_id INTEGER NOT NULL REFERENCES profile (id),
+            text TEXT NOT NULL,
+            created_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_date TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            version INTEGER NOT NULL DEFAULT 1,
+            CONSTRAINT message_pkey PRIMARY KEY (id, created_date)
+        ) PARTITION BY RANGE (created_date)
+    """)
+    op.execute('ALTER SEQUENCE message_id_seq OWNED BY message.id')
+    op.create_index('ix_message_group_id_id', 'message', ['group_id', 'id'])
+
+    oldest = conn.execute(sa.text('SELECT min(created_date) FROM message_legacy')).scalar()
+    ensure_partitions(conn, months_ahead=3, start=oldest.date() if oldest else None)
+
+    op.execute(f'INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_legacy')
+    op.execute('DROP TABLE message_legacy')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('ALTER TABLE message RENAME TO message_partitioned')
+    op.execute('ALTER TABLE message_partitioned RENAME CONSTRAINT message_pkey TO message_partitioned_pkey')
+    op.execute('ALTER INDEX ix_message_group_id_id RENAME TO ix_message_partitioned_group_id_id')
+    op.execute("""
+        CREATE TABLE message (
+            id INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            group_id INTEGER NOT NULL REFERENCES "group" (id),
+            user_id INTEGER NOT NULL REFERENCES profile (id),
+            text TEXT NOT NULL,
+            created_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_date TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            version INTEGER NOT NULL DEFAULT 1,
+            CONSTRAINT message_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute('ALTER SEQUENCE message_id_seq OWNED BY message.id')
+    op.create_index('ix_message_group_id_id', 'message', ['group_id', 'id'])
+    op.execute(f'INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_partitioned')
+    op.execute('DROP TABLE message_partitioned')
@@ -0,0 +1,40 @@
+"""one attachment row per upload
+
+Revision ID: b7e4c19d2a06
+Revises: 8f1a6d3c0b52
+Create Date: 2026-10-19 15:34:52.816340
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e4c19d2a06'
+down_revision: Union[str, Sequence[str], None] = '8f1a6d3c0b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.drop_constraint('attachment_sha256_key', 'attachment', type_='unique')
+    op.create_index('ix_attachment_sha256', 'attachment', ['sha256'])
+    op.create_index('ix_message_attachment_id', 'message', ['attachment_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_message_attachment_id', table_name='message')
+    # fold uploads of the same content back into the oldest row
+    op.execute("""
+        UPDATE message m SET attachment_id = keep.id
+        FROM attachment a
+        JOIN (SELECT sha256, min(id) AS id FROM attachment GROUP BY sha256) keep ON keep.sha256 = a.sha256
+        WHERE m.attachment_id = a.id AND a.id <> keep.id
+    """)
+    op.execute('DELETE FROM attachment a USING attachment b WHERE a.sha256 = b.sha256 AND a.id > b.id')
+    op.drop_index('ix_attachment_sha256', table_name='attachment')
+    op.create_unique_constraint('attachment_sha256_key', 'attachment', ['sha256'])
@@ -0,0 +1,35 @@
+"""add message idempotency keys
+
+Revision ID: de38fe922756
+Revises: 9b3f5c1e8a27
+Create Date: 2026-10-19 11:41:05.227184
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'de38fe922756'
+down_revision: Union[str, Sequence[str], None] = '9b3f5c1e8a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('message_idempotency',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('created_date', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    sa.ForeignKeyConstraint(['user_id'], ['profile.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'key')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('message_idempotency')
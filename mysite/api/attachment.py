@@ -0,0 +1,69 @@
+from fastapi import HTTPException, Depends, APIRouter, Request
+from fastapi.responses import FileResponse
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from mysite.attachments import attachment_store, receive_upload, UploadError
+from mysite.config import ATTACHMENT_MAX_SIZE
+from mysite.database.db import request_session
+from mysite.database.models import Attachment, UserProfile, ChatMessage, GroupPeople
+from typing import Optional
+from mysite.database.schema import AttachmentOutSchema
+from starlette.concurrency import run_in_threadpool
+
+
+async def get_db(request: Request):
+    db = request_session(request)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+attachment_router = APIRouter(prefix='/attachment', tags=['Attachment'])
+
+
+def readable_attachment(db: Session, attachment_id: int, user_id: int) -> Optional[Attachment]:
+    # the uploader, or a member of a group where a message carries the attachment
+    shared = db.query(ChatMessage.id).join(
+        GroupPeople, GroupPeople.group_id == ChatMessage.group_id
+    ).filter(ChatMessage.attachment_id == attachment_id, GroupPeople.user_id == user_id).exists()
+    return db.query(Attachment).filter(
+        Attachment.id == attachment_id,
+        or_(Attachment.uploader_id == user_id, shared)
+    ).first()
+
+
+@attachment_router.post('/', response_model=AttachmentOutSchema)
+async def attachment_upload(user_id: int, request: Request, db: Session = Depends(get_db)):
+    user = db.query(UserProfile.id).filter(UserProfile.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
+
+    try:
+        upload = await receive_upload(request, attachment_store, ATTACHMENT_MAX_SIZE)
+    except UploadError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+
+    attachment_db = Attachment(sha256=upload.sha256, size=upload.size, content_type=upload.content_type,
+                               filename=upload.filename[:255], uploader_id=user_id)
+    db.add(attachment_db)
+    db.commit()
+    db.refresh(attachment_db)
+    return attachment_db
+
+
+@attachment_router.get('/{attachment_id}')
+async def attachment_download(attachment_id: int, current_user_id: int, db: Session = Depends(get_db)):
+    # a file the caller may not see is reported as missing
+    attachment_db = readable_attachment(db, attachment_id, current_user_id)
+    if not attachment_db:
+        raise HTTPException(status_code=404, detail='Файл табылган жок')
+
+    path = attachment_store.path_for(attachment_db.sha256)
+    if not await run_in_threadpool(attachment_store.exists, attachment_db.sha256):
+        raise HTTPException(status_code=404, detail='Файл табылган жок')
+
+    # the content never changes for a given id; Range requests are answered by FileResponse
+    return FileResponse(path, media_type=attachment_db.content_type, filename=attachment_db.filename,
+                        headers={'Cache-Control': 'private, max-age=31536000, immutable',
+                                 'X-Content-Type-Options': 'nosniff'})
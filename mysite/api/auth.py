@@ -1,8 +1,11 @@
-from fastapi import HTTPException, Depends, APIRouter
+from fastapi import HTTPException, Depends, APIRouter, Request
 from mysite.database.models import UserProfile, ChatGroup, GroupPeople, ChatMessage
 from mysite.database.schema import (UserProfileCreateSchema, UserProfileLoginSchema,
                                 UserProfileOutSchema)
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session
+from mysite.cache import invalidate_user
+from mysite.database.archive import message_archive
+from mysite.api.chat_wb import manager
 from sqlalchemy.orm import Session
 from typing import Optional
 from passlib.context import CryptContext
@@ -14,8 +17,8 @@ from mysite.config import (ALGORITHM, SECRET_KEY,
 from datetime import timedelta, datetime
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -118,7 +121,12 @@ async def delete_user(user_id: int, db: Session = Depends(get_db)):
     if user_db is None:
         raise HTTPException(status_code=404, detail='User not found')
 
+    owned = [r[0] for r in db.query(ChatGroup.id).filter(ChatGroup.owner_id == user_id).all()]
     db.delete(user_db)
     db.commit()
+    for group_id in owned:
+        message_archive.drop_group(group_id)
+    await invalidate_user(user_id)
+    manager.forget_user(user_id, owned)
 
     return {'message': 'User deleted successfully'}
\ No newline at end of file
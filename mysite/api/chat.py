@@ -1,13 +1,17 @@
-from fastapi import HTTPException, Depends, APIRouter
+from fastapi import HTTPException, Depends, APIRouter, Request, Response, BackgroundTasks
 from mysite.database.models import ChatGroup, UserProfile, StatusChoices
 from mysite.database.schema import ChatGroupCreateSchema, ChatGroupOutSchema
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session
+from mysite.database.purge import delete_group
+from mysite.cache import response_cache, invalidate_members, invalidate_recent
+from mysite.serialize import schema_columns, rows_response
+from mysite.api.chat_wb import manager
 from sqlalchemy.orm import Session
 from typing import List
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -18,7 +22,7 @@ group_chat_router = APIRouter(prefix='/group', tags=['Chat Group'])
 
 
 def check_group_owner(group_id: int, user_id: int, db: Session):
-    group = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+    group = db.query(ChatGroup).filter(ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
@@ -42,17 +46,21 @@ async def group_create(group: ChatGroupCreateSchema, db: Session = Depends(get_d
     db.add(group_db)
     db.commit()
     db.refresh(group_db)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', group_db.owner_id)
     return {'message': 'Saved'}
 
 
 @group_chat_router.get('/', response_model=List[ChatGroupOutSchema])
 async def group_list(db: Session = Depends(get_db)):
-    return db.query(ChatGroup).all()
+    return rows_response(ChatGroupOutSchema, db.query(*schema_columns(ChatGroup, ChatGroupOutSchema)).filter(
+        ChatGroup.deleted_date.is_(None)).all())
 
 
 @group_chat_router.get('/{group_id}', response_model=ChatGroupOutSchema)
 async def group_detail(group_id: int, db: Session = Depends(get_db)):
-    group_db = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+    group_db = db.query(ChatGroup).filter(ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group_db:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
     return group_db
@@ -67,21 +75,36 @@ async def group_update(group_id: int, group: ChatGroupCreateSchema,
     if not owner:
         raise HTTPException(status_code=404, detail='Ээси табылган жок')
 
+    old_owner_id = group_db.owner_id
     for group_key, group_value in group.dict().items():
         setattr(group_db, group_key, group_value)
 
     db.add(group_db)
     db.commit()
     db.refresh(group_db)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', old_owner_id)
+    await response_cache.invalidate('groups_by_owner', group_db.owner_id)
     return group_db
 
 
 @group_chat_router.delete('/{group_id}')
-async def group_delete(group_id: int, current_user_id: int, db: Session = Depends(get_db)):
+async def group_delete(group_id: int, current_user_id: int, response: Response,
+                       background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     group_db = check_group_owner(group_id, current_user_id, db)
-
-    db.delete(group_db)
-    db.commit()
+    owner_id = group_db.owner_id
+
+    deferred = delete_group(db, group_db, background_tasks.add_task)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', owner_id)
+    await invalidate_members(group_id)
+    manager.drop_group(group_id)
+    invalidate_recent(group_id)
+    if deferred:
+        response.status_code = 202
+        return {'message': 'Deleting'}
     return {'message': 'Deleted'}
 
 
@@ -91,4 +114,6 @@ async def groups_by_owner(owner_id: int, db: Session = Depends(get_db)):
     if not owner:
         raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
 
-    return db.query(ChatGroup).filter(ChatGroup.owner_id == owner_id).all()
\ No newline at end of file
+    groups = db.query(*schema_columns(ChatGroup, ChatGroupOutSchema)).filter(
+        ChatGroup.owner_id == owner_id, ChatGroup.deleted_date.is_(None)).all()
+    return rows_response(ChatGroupOutSchema, groups)
\ No newline at end of file
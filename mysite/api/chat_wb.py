@@ -1,13 +1,41 @@
-from typing import Dict, Set, List, Optional, Any
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Set, List, Optional, Any, Callable, Union, FrozenSet
+from datetime import datetime, timedelta
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from jose import jwt, JWTError
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from mysite.database.db import SessionLocal
+from starlette.concurrency import run_in_threadpool
+from mysite.database.db import SessionLocal, read_session
 from mysite.database.models import UserProfile, ChatGroup, GroupPeople, ChatMessage
-from mysite.config import SECRET_KEY, ALGORITHM
+from mysite.database.schema import (CreateGroupActionSchema, ListGroupsActionSchema, RenameGroupActionSchema,
+                                    AddMembersActionSchema, SendMessageActionSchema, FetchMessagesActionSchema,
+                                    SyncActionSchema, FetchLatestActionSchema, TypingActionSchema)
+from mysite.database.archive import message_archive
+from mysite.database.history import latest_messages
+from mysite.database.idempotency import create_message, IdempotencyConflict
+from mysite.config import (SECRET_KEY, ALGORITHM, MESSAGE_HISTORY_WINDOW_DAYS, WS_SYNC_MAX_MESSAGES, WS_TYPING_TTL_MS,
+                           WS_DRAIN_SECONDS, WS_HEARTBEAT_INTERVAL, WS_HEARTBEAT_TIMEOUT)
+from mysite.cache import response_cache, member_cache, recent_messages, invalidate_members, append_recent
+from mysite.bus import bus
+from mysite.metrics import WS_CONNECTIONS, WS_USERS, WS_REJECTED, WS_REAPED, observe_broadcast
+from mysite.api.ws_dispatch import ActionDispatcher, ActionError, ws_action, send_error
+from mysite.api.ws_codec import (EncodedEvent, accept, close_batcher, close_socket, send_event, receive_event,
+                                 wants_heartbeat)
+from mysite.api.ws_admission import (admission, reconnect_event, retry_delay, SERVICE_RESTART,
+                                     TRY_AGAIN_LATER)
+from mysite.api.ws_typing import TypingTracker
+from mysite.api.ws_offline import OfflineQueue, load_notifier
+from mysite.api.attachment import readable_attachment
 
 chat_router = APIRouter(tags=["Chat WS"])
 
+logger = logging.getLogger("mysite.ws")
+
+
 def _extract_token(websocket: WebSocket, token_q: Optional[str]) -> Optional[str]:
     if token_q:
         return token_q
@@ -36,37 +64,259 @@ def get_user_from_token(db: Session, token: str) -> UserProfile:
     return user
 
 
+GOING_AWAY = 1001
+
+
 class ConnectionManager:
-    def __init__(self) -> None:
+    # sockets and rooms are per worker. Public methods that change rooms or send to users
+    # are repeated on the other workers over the bus; the _local ones touch this worker only
+    def __init__(self, heartbeat_interval: float = WS_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = WS_HEARTBEAT_TIMEOUT) -> None:
         self._connections: Dict[int, Set[WebSocket]] = {}
-
-    async def connect(self, user_id: int, websocket: WebSocket) -> None:
-        await websocket.accept()
-        self._connections.setdefault(user_id, set()).add(websocket)
+        # only sockets that opted into the app heartbeat; the rest rely on protocol pings
+        self._last_seen: Dict[WebSocket, float] = {}
+        # group id -> live sockets of its members (socket -> user id), and the reverse per user
+        self._rooms: Dict[int, Dict[WebSocket, int]] = {}
+        self._user_groups: Dict[int, Set[int]] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = max(heartbeat_timeout, heartbeat_interval)
+        self.draining = False
+
+    async def connect(self, user_id: int, websocket: WebSocket, batch: bool = False) -> None:
+        await accept(websocket, batch=batch)
+        conns = self._connections.setdefault(user_id, set())
+        if websocket not in conns:
+            conns.add(websocket)
+            if wants_heartbeat(websocket):
+                self._last_seen[websocket] = time.monotonic()
+            if len(conns) == 1:
+                bus.set_online(user_id, True)
+            WS_CONNECTIONS.inc()
+            WS_USERS.set(len(self._connections))
+        if (websocket in self._last_seen and self.heartbeat_interval > 0
+                and (self._heartbeat is None or self._heartbeat.done())):
+            self._heartbeat = asyncio.create_task(self._run_heartbeat())
+
+    def close(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    def touch(self, websocket: WebSocket) -> None:
+        # any frame from the client proves the connection is alive, a pong included
+        if websocket in self._last_seen:
+            self._last_seen[websocket] = time.monotonic()
+
+    def last_seen(self, websocket: WebSocket) -> Optional[float]:
+        return self._last_seen.get(websocket)
+
+    def heartbeat_ms(self, websocket: WebSocket) -> int:
+        # 0 tells the client it will never be pinged by the app
+        return int(self.heartbeat_interval * 1000) if websocket in self._last_seen else 0
 
     def disconnect(self, user_id: int, websocket: WebSocket) -> None:
-        if user_id in self._connections:
+        close_batcher(websocket)
+        if user_id in self._connections and websocket in self._connections[user_id]:
             self._connections[user_id].discard(websocket)
+            self._last_seen.pop(websocket, None)
+            for gid in self._user_groups.get(user_id, ()):
+                self._leave_room(gid, websocket)
+            WS_CONNECTIONS.dec()
             if not self._connections[user_id]:
                 self._connections.pop(user_id, None)
-
-    async def send_to_user(self, user_id: int, payload: dict) -> None:
+                self._user_groups.pop(user_id, None)
+                bus.set_online(user_id, False)
+            WS_USERS.set(len(self._connections))
+
+    def join_rooms(self, user_id: int, websocket: WebSocket, group_ids: List[int]) -> None:
+        # called after connect() registered the socket, so a join_group racing with the
+        # membership query still finds it
+        if websocket not in self._connections.get(user_id, ()):
+            return
+        for gid in group_ids:
+            self._rooms.setdefault(gid, {})[websocket] = user_id
+        self._user_groups.setdefault(user_id, set()).update(group_ids)
+
+    def join_group(self, group_id: int, user_ids: List[int]) -> None:
+        bus.publish('join_group', group_id=group_id, user_ids=user_ids)
+        self._join_group_local(group_id, user_ids)
+
+    def _join_group_local(self, group_id: int, user_ids: List[int]) -> None:
+        for uid in user_ids:
+            sockets = self._connections.get(uid)
+            if not sockets:
+                continue
+            room = self._rooms.setdefault(group_id, {})
+            for ws in sockets:
+                room[ws] = uid
+            self._user_groups.setdefault(uid, set()).add(group_id)
+
+    def leave_group(self, group_id: int, user_ids: List[int]) -> None:
+        bus.publish('leave_group', group_id=group_id, user_ids=user_ids)
+        self._leave_group_local(group_id, user_ids)
+
+    def _leave_group_local(self, group_id: int, user_ids: List[int]) -> None:
+        for uid in user_ids:
+            groups = self._user_groups.get(uid)
+            if groups is not None:
+                groups.discard(group_id)
+            for ws in self._connections.get(uid, ()):
+                self._leave_room(group_id, ws)
+
+    def drop_group(self, group_id: int) -> None:
+        bus.publish('drop_group', group_id=group_id)
+        self._drop_group_local(group_id)
+
+    def _drop_group_local(self, group_id: int) -> None:
+        for uid in set(self._rooms.pop(group_id, {}).values()):
+            groups = self._user_groups.get(uid)
+            if groups is not None:
+                groups.discard(group_id)
+
+    def leave_all(self, user_id: int) -> None:
+        for gid in self._user_groups.pop(user_id, set()):
+            for ws in self._connections.get(user_id, ()):
+                self._leave_room(gid, ws)
+
+    def forget_user(self, user_id: int, owned_group_ids: List[int]) -> None:
+        # a deleted user leaves every room, and the groups they owned are gone with them
+        bus.publish('forget_user', user_id=user_id, owned_group_ids=owned_group_ids)
+        self._forget_user_local(user_id, owned_group_ids)
+
+    def _forget_user_local(self, user_id: int, owned_group_ids: List[int]) -> None:
+        self.leave_all(user_id)
+        for gid in owned_group_ids:
+            self._drop_group_local(gid)
+
+    def _leave_room(self, group_id: int, websocket: WebSocket) -> None:
+        room = self._rooms.get(group_id)
+        if room is not None:
+            room.pop(websocket, None)
+            if not room:
+                del self._rooms[group_id]
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._connections
+
+    async def send_to_user(self, user_id: int, payload: Union[dict, EncodedEvent]) -> int:
+        # returns the sockets reached on this worker
+        bus.publish('send_to_user', user_id=user_id,
+                    payload=payload.payload if isinstance(payload, EncodedEvent) else payload)
+        return await self._send_to_user_local(user_id, payload)
+
+    async def _send_to_user_local(self, user_id: int, payload: Union[dict, EncodedEvent]) -> int:
         conns = list(self._connections.get(user_id, []))
         dead: List[WebSocket] = []
         for ws in conns:
             try:
-                await ws.send_json(payload)
+                await send_event(ws, payload)
             except Exception:
                 dead.append(ws)
         for ws in dead:
             self.disconnect(user_id, ws)
-
-    async def broadcast_to_users(self, user_ids: List[int], payload: dict) -> None:
-        for uid in set(user_ids):
-            await self.send_to_user(uid, payload)
+        return len(conns) - len(dead)
+
+    async def broadcast_to_group(self, group_id: int, payload: dict, exclude: Optional[int] = None) -> Set[int]:
+        # returns the users reached on this worker
+        bus.publish('broadcast', group_id=group_id, payload=payload, exclude=exclude)
+        return await self._broadcast_local(group_id, payload, exclude)
+
+    async def _broadcast_local(self, group_id: int, payload: dict, exclude: Optional[int] = None) -> Set[int]:
+        # touches only the group's live sockets. The room only picks the sockets, membership
+        # decides who may receive. A fan-out never waits on the DB: on a cache miss the room,
+        # which follows every join and leave, stands in until the cache is warm again
+        started = time.perf_counter()
+        event = EncodedEvent(payload)
+        members = member_cache.get(group_id)
+        if members is None:
+            refresh_members(group_id)
+        reached: Set[int] = set()
+        delivered = 0
+        dead: List[tuple] = []
+        for ws, uid in list(self._rooms.get(group_id, {}).items()):
+            if uid == exclude:
+                continue
+            if members is not None and uid not in members:
+                self._leave_group_local(group_id, [uid])
+                continue
+            try:
+                await send_event(ws, event)
+            except Exception:
+                dead.append((uid, ws))
+                continue
+            reached.add(uid)
+            delivered += 1
+        for uid, ws in dead:
+            self.disconnect(uid, ws)
+        observe_broadcast(delivered, started)
+        return reached
+
+    async def _run_heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            stale: List[tuple] = []
+            quiet: List[tuple] = []
+            for uid, sockets in list(self._connections.items()):
+                for ws in list(sockets):
+                    if ws not in self._last_seen:
+                        continue
+                    idle = now - self._last_seen[ws]
+                    if idle >= self.heartbeat_timeout:
+                        stale.append((uid, ws))
+                    elif idle >= self.heartbeat_interval:
+                        quiet.append((uid, ws))
+            await asyncio.gather(*(self._reap(uid, ws) for uid, ws in stale),
+                                 *(self._ping(uid, ws) for uid, ws in quiet))
+
+    async def _ping(self, user_id: int, websocket: WebSocket) -> None:
+        try:
+            await asyncio.wait_for(send_event(websocket, {"event": "ping"}), self.heartbeat_interval)
+        except Exception:
+            self.disconnect(user_id, websocket)
+
+    async def _reap(self, user_id: int, websocket: WebSocket) -> None:
+        # out of the broadcast sets first, the close itself may never complete on a dead peer
+        self.disconnect(user_id, websocket)
+        WS_REAPED.inc()
+        try:
+            await asyncio.wait_for(websocket.close(code=GOING_AWAY), self.heartbeat_interval)
+        except Exception:
+            pass
+
+    async def drain(self, window: float = WS_DRAIN_SECONDS) -> None:
+        # each client learns right away when it will be closed, and the closes are spread
+        # over the window so the reconnects reach the other workers gradually
+        self.draining = True
+        conns = [(uid, ws) for uid, sockets in self._connections.items() for ws in sockets]
+        await asyncio.gather(*(self._drain_one(uid, ws, random.uniform(0, window)) for uid, ws in conns))
+
+    async def _drain_one(self, user_id: int, websocket: WebSocket, delay: float) -> None:
+        try:
+            await send_event(websocket, reconnect_event(delay))
+            await asyncio.sleep(delay)
+            await close_socket(websocket, SERVICE_RESTART)
+        except Exception:
+            pass
+        self.disconnect(user_id, websocket)
 
 
 manager = ConnectionManager()
+bus.on('join_group', manager._join_group_local)
+bus.on('leave_group', manager._leave_group_local)
+bus.on('drop_group', manager._drop_group_local)
+bus.on('forget_user', manager._forget_user_local)
+bus.on('send_to_user', manager._send_to_user_local)
+bus.on('broadcast', manager._broadcast_local)
+
+
+async def turn_away(websocket: WebSocket, reason: str, code: int) -> None:
+    # rejected before the token is checked, so a reconnect storm costs no DB work
+    WS_REJECTED.labels(reason).inc()
+    await accept(websocket)
+    await send_event(websocket, reconnect_event(retry_delay()))
+    await websocket.close(code=code)
 
 
 def is_member(db: Session, group_id: int, user_id: int) -> bool:
@@ -77,7 +327,7 @@ def is_member(db: Session, group_id: int, user_id: int) -> bool:
 
 
 def get_group(db: Session, group_id: int) -> Optional[ChatGroup]:
-    return db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+    return db.query(ChatGroup).filter(ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
 
 
 def group_member_ids(db: Session, group_id: int) -> List[int]:
@@ -85,6 +335,52 @@ def group_member_ids(db: Session, group_id: int) -> List[int]:
     return [r[0] for r in rows]
 
 
+def members_by_group(db: Session, group_ids: List[int]) -> Dict[int, List[int]]:
+    members: Dict[int, List[int]] = {gid: [] for gid in group_ids}
+    rows = db.query(GroupPeople.group_id, GroupPeople.user_id).filter(GroupPeople.group_id.in_(group_ids)).all()
+    for gid, uid in rows:
+        members[gid].append(uid)
+    return members
+
+
+def user_group_ids(db: Session, user_id: int) -> List[int]:
+    rows = (
+        db.query(GroupPeople.group_id)
+        .join(ChatGroup, ChatGroup.id == GroupPeople.group_id)
+        .filter(GroupPeople.user_id == user_id, ChatGroup.deleted_date.is_(None))
+        .all()
+    )
+    return [r[0] for r in rows]
+
+
+def fetch_message_page(db: Session, group_id: int, limit: int,
+                       before_id: Optional[int] = None) -> List[ChatMessage]:
+    q = db.query(ChatMessage).filter(ChatMessage.group_id == group_id)
+    upper = datetime.utcnow()
+    if before_id:
+        q = q.filter(ChatMessage.id < before_id)
+        cursor_date = db.query(ChatMessage.created_date).filter(ChatMessage.id == before_id).scalar()
+        if cursor_date is not None:
+            upper = cursor_date + timedelta(minutes=1)
+            q = q.filter(ChatMessage.created_date <= upper)
+
+    # bound created_date so the planner only touches the newest partitions
+    lower = upper - timedelta(days=MESSAGE_HISTORY_WINDOW_DAYS)
+    msgs = q.filter(ChatMessage.created_date >= lower).order_by(ChatMessage.id.desc()).limit(limit).all()
+    if len(msgs) < limit and has_older_messages(db, q, group_id, lower):
+        msgs = q.order_by(ChatMessage.id.desc()).limit(limit).all()
+    return list(reversed(msgs))
+
+
+def has_older_messages(db: Session, q, group_id: int, lower: datetime) -> bool:
+    # a group created inside the window cannot have older rows; otherwise probe before
+    # paying for a query over every partition
+    created = db.query(ChatGroup.create_date).filter(ChatGroup.id == group_id).scalar()
+    if created is None or created >= lower:
+        return False
+    return db.query(q.filter(ChatMessage.created_date < lower).exists()).scalar()
+
+
 def group_to_dict(g: ChatGroup) -> dict:
     return {
         "id": g.id,
@@ -100,186 +396,394 @@ def msg_to_dict(m: ChatMessage) -> dict:
         "group_id": m.group_id,
         "user_id": m.user_id,
         "text": m.text,
+        "attachment_id": m.attachment_id,
         "created_date": m.created_date.isoformat() if m.created_date else None,
     }
 
 
-@chat_router.websocket("/ws/chat")
-async def chat_ws(websocket: WebSocket, token: Optional[str] = Query(default=None)):
-    db = SessionLocal()
-    user: Optional[UserProfile] = None
+async def run_db(fn: Callable, *args, read_for: Optional[int] = None) -> Any:
+    def call():
+        db = read_session(("user", read_for)) if read_for is not None else SessionLocal()
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+    return await run_in_threadpool(call)
+
+
+def _load_recent(db: Session, group_id: int, size: int) -> tuple:
+    items = [msg_to_dict(m) for m in fetch_message_page(db, group_id, size)]
+    return items, len(items) < size and not message_archive.boundary(group_id)
+
+
+async def latest_page(group_id: int, limit: int) -> Optional[List[dict]]:
+    # the newest `limit` messages from the ring buffer, filling it from the primary on a miss;
+    # None when the buffer cannot answer, e.g. the rest of the page is in the archive
+    if limit > recent_messages.size:
+        return None
+    items = recent_messages.latest(group_id, limit)
+    if items is None and not recent_messages.buffered(group_id):
+        with recent_messages.loading(group_id) as store:
+            store(*await run_db(_load_recent, group_id, recent_messages.size))
+        items = recent_messages.latest(group_id, limit)
+    return items
+
 
+async def cached_member_ids(group_id: int) -> FrozenSet[int]:
+    members = member_cache.get(group_id)
+    if members is None:
+        members = member_cache.set(group_id, await run_db(group_member_ids, group_id))
+    return members
+
+
+async def warm_members(group_ids: List[int]) -> None:
+    # one query for every group not cached yet, so broadcasts to them find their members
+    missing = [gid for gid in group_ids if member_cache.get(gid) is None]
+    if missing:
+        for gid, uids in (await run_db(members_by_group, missing)).items():
+            member_cache.set(gid, uids)
+
+
+_warming: Dict[int, asyncio.Task] = {}
+
+
+def refresh_members(group_id: int) -> None:
+    if group_id in _warming:
+        return
+    task = _warming[group_id] = asyncio.create_task(_refresh_members(group_id))
+    task.add_done_callback(lambda t: _warming.pop(group_id, None))
+
+
+async def _refresh_members(group_id: int) -> None:
     try:
-        tok = _extract_token(websocket, token)
-        if not tok:
-            await websocket.accept()
-            await websocket.send_json({"event": "error", "detail": "Missing token"})
-            await websocket.close(code=1008)
-            return
+        await warm_members([group_id])
+    except Exception:
+        logger.exception("member cache refresh failed for group %s", group_id)
 
-        try:
-            user = get_user_from_token(db, tok)
-        except ValueError:
-            await websocket.accept()
-            await websocket.send_json({"event": "error", "detail": "Invalid token"})
-            await websocket.close(code=1008)
-            return
 
-        await manager.connect(user.id, websocket)
-        await websocket.send_json({"event": "connected", "user_id": user.id, "username": user.username})
+async def publish_typing(user_id: int, group_id: int, typing: bool) -> None:
+    await manager.broadcast_to_group(group_id, {
+        "event": "typing",
+        "group_id": group_id,
+        "user_id": user_id,
+        "typing": typing,
+        "expires_in": WS_TYPING_TTL_MS
+    }, exclude=user_id)
 
-        while True:
-            data: Dict[str, Any] = await websocket.receive_json()
-            action = data.get("action")
 
-            if action == "create_group":
-                name = (data.get("name") or "").strip()
-                if not name:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "name is required"})
-                    continue
+typing_tracker = TypingTracker(publish_typing)
 
-                g = ChatGroup(name=name, owner_id=user.id)
-                db.add(g)
-                db.commit()
-                db.refresh(g)
 
-                db.add(GroupPeople(group_id=g.id, user_id=user.id))
-                db.commit()
+async def send_digest(user_id: int, digests: List[dict]) -> None:
+    await manager.send_to_user(user_id, {"event": "digest", "groups": digests})
 
-                await websocket.send_json({"event": "group_created", "group": group_to_dict(g)})
-                continue
 
-            if action == "list_groups":
-                groups = (
-                    db.query(ChatGroup)
-                    .join(GroupPeople, GroupPeople.group_id == ChatGroup.id)
-                    .filter(GroupPeople.user_id == user.id)
-                    .order_by(ChatGroup.id.desc())
-                    .all()
-                )
-                await websocket.send_json({"event": "groups", "items": [group_to_dict(g) for g in groups]})
-                continue
+offline_queue = OfflineQueue(load_notifier(), cached_member_ids, manager.is_online, bus.online, send_digest)
 
-            if action == "rename_group":
-                group_id = data.get("group_id")
-                new_name = (data.get("name") or "").strip()
 
-                if not group_id or not new_name:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group_id and name required"})
-                    continue
+async def take_digests(user_id: int) -> None:
+    # the user connected to another worker; digests queued here follow them there
+    digests = offline_queue.take(user_id)
+    if digests:
+        await send_digest(user_id, digests)
 
-                g = get_group(db, int(group_id))
-                if not g:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group not found"})
-                    continue
-                if g.owner_id != user.id:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "only owner can rename"})
-                    continue
 
-                g.name = new_name
-                db.commit()
-                db.refresh(g)
+bus.on('user_online', take_digests)
 
-                members = group_member_ids(db, g.id)
-                await manager.broadcast_to_users(members, {"event": "group_renamed", "group": group_to_dict(g)})
-                continue
 
-            if action == "add_members":
-                group_id = data.get("group_id")
-                user_ids = data.get("user_ids") or []
-
-                if not group_id or not isinstance(user_ids, list) or not user_ids:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group_id and user_ids required"})
-                    continue
-
-                g = get_group(db, int(group_id))
-                if not g:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group not found"})
-                    continue
-                if g.owner_id != user.id:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "only owner can add members"})
-                    continue
-
-                added: List[int] = []
-                for uid in user_ids:
-                    if not isinstance(uid, int):
-                        continue
+def by_group(payload) -> tuple:
+    return ("group", payload.group_id)
 
-                    exists_user = db.query(UserProfile.id).filter(UserProfile.id == uid).first()
-                    if not exists_user:
-                        continue
 
-                    already = db.query(GroupPeople).filter(
-                        GroupPeople.group_id == g.id,
-                        GroupPeople.user_id == uid
-                    ).first()
-                    if already:
-                        continue
+def _create_group(db: Session, user_id: int, name: str) -> dict:
+    g = ChatGroup(name=name, owner_id=user_id)
+    db.add(g)
+    db.commit()
+    db.refresh(g)
 
-                    db.add(GroupPeople(group_id=g.id, user_id=uid))
-                    added.append(uid)
+    db.add(GroupPeople(group_id=g.id, user_id=user_id))
+    db.commit()
+    return group_to_dict(g)
 
-                db.commit()
 
-                members = group_member_ids(db, g.id)
-                await manager.broadcast_to_users(members, {
-                    "event": "members_added",
-                    "group_id": g.id,
-                    "added_user_ids": added
-                })
-                continue
+@ws_action("create_group", CreateGroupActionSchema)
+async def create_group(conn: ActionDispatcher, payload: CreateGroupActionSchema) -> dict:
+    group = await run_db(_create_group, conn.user_id, payload.name)
 
-            if action == "send_message":
-                group_id = data.get("group_id")
-                text = (data.get("text") or "").strip()
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', conn.user_id)
+    await invalidate_members(group["id"])
+    manager.join_group(group["id"], [conn.user_id])
+    await warm_members([group["id"]])
+    return {"event": "group_created", "group": group}
 
-                if not group_id or not text:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group_id and text required"})
-                    continue
 
-                group_id = int(group_id)
-                if not is_member(db, group_id, user.id):
-                    await websocket.send_json({"event": "error", "action": action, "detail": "not a member"})
-                    continue
+def _list_groups(db: Session, user_id: int) -> List[dict]:
+    groups = (
+        db.query(ChatGroup)
+        .join(GroupPeople, GroupPeople.group_id == ChatGroup.id)
+        .filter(GroupPeople.user_id == user_id)
+        .order_by(ChatGroup.id.desc())
+        .all()
+    )
+    return [group_to_dict(g) for g in groups]
 
-                m = ChatMessage(group_id=group_id, user_id=user.id, text=text)
-                db.add(m)
-                db.commit()
-                db.refresh(m)
 
-                members = group_member_ids(db, group_id)
-                await manager.broadcast_to_users(members, {"event": "message", "message": msg_to_dict(m)})
-                continue
+@ws_action("list_groups", ListGroupsActionSchema, read_only=True)
+async def list_groups(conn: ActionDispatcher, payload: ListGroupsActionSchema) -> dict:
+    return {"event": "groups", "items": await run_db(_list_groups, conn.user_id, read_for=conn.user_id)}
 
-            if action == "fetch_messages":
-                group_id = data.get("group_id")
-                limit = int(data.get("limit") or 50)
-                before_id = data.get("before_id")
 
-                if not group_id:
-                    await websocket.send_json({"event": "error", "action": action, "detail": "group_id required"})
-                    continue
+def _rename_group(db: Session, user_id: int, group_id: int, name: str) -> dict:
+    g = get_group(db, group_id)
+    if not g:
+        raise ActionError("group not found")
+    if g.owner_id != user_id:
+        raise ActionError("only owner can rename")
 
-                group_id = int(group_id)
-                if not is_member(db, group_id, user.id):
-                    await websocket.send_json({"event": "error", "action": action, "detail": "not a member"})
-                    continue
+    g.name = name
+    db.commit()
+    db.refresh(g)
+    return group_to_dict(g)
 
-                q = db.query(ChatMessage).filter(ChatMessage.group_id == group_id)
-                if before_id:
-                    q = q.filter(ChatMessage.id < int(before_id))
 
-                msgs = q.order_by(ChatMessage.id.desc()).limit(min(limit, 200)).all()
-                msgs = list(reversed(msgs))
+@ws_action("rename_group", RenameGroupActionSchema, order_key=by_group)
+async def rename_group(conn: ActionDispatcher, payload: RenameGroupActionSchema) -> None:
+    group = await run_db(_rename_group, conn.user_id, payload.group_id, payload.name)
 
-                await websocket.send_json({"event": "messages", "group_id": group_id, "items": [msg_to_dict(x) for x in msgs]})
-                continue
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', group["owner_id"])
+    await manager.broadcast_to_group(payload.group_id, {"event": "group_renamed", "group": group})
+
+
+def _add_members(db: Session, user_id: int, group_id: int, user_ids: List[int]) -> List[int]:
+    g = get_group(db, group_id)
+    if not g:
+        raise ActionError("group not found")
+    if g.owner_id != user_id:
+        raise ActionError("only owner can add members")
+
+    added: List[int] = []
+    for uid in user_ids:
+        exists_user = db.query(UserProfile.id).filter(UserProfile.id == uid).first()
+        if not exists_user:
+            continue
+
+        already = db.query(GroupPeople).filter(
+            GroupPeople.group_id == g.id,
+            GroupPeople.user_id == uid
+        ).first()
+        if already:
+            continue
+
+        db.add(GroupPeople(group_id=g.id, user_id=uid))
+        added.append(uid)
+
+    db.commit()
+    return added
 
-            await websocket.send_json({"event": "error", "detail": f"Unknown action: {action}"})
+
+@ws_action("add_members", AddMembersActionSchema, order_key=by_group)
+async def add_members(conn: ActionDispatcher, payload: AddMembersActionSchema) -> None:
+    added = await run_db(_add_members, conn.user_id, payload.group_id, payload.user_ids)
+
+    await invalidate_members(payload.group_id)
+    manager.join_group(payload.group_id, added)
+    await warm_members([payload.group_id])
+    await manager.broadcast_to_group(payload.group_id, {
+        "event": "members_added",
+        "group_id": payload.group_id,
+        "added_user_ids": added
+    })
+
+
+def _send_message(db: Session, user_id: int, group_id: int, text: str, key: Optional[str],
+                  attachment_id: Optional[int]) -> tuple:
+    if not is_member(db, group_id, user_id):
+        raise ActionError("not a member")
+    if attachment_id is not None and not readable_attachment(db, attachment_id, user_id):
+        raise ActionError("attachment not found")
+
+    try:
+        m, created = create_message(db, group_id, user_id, text, key, attachment_id)
+    except IdempotencyConflict:
+        raise ActionError("idempotency key already used for a different message")
+    return msg_to_dict(m), created
+
+
+@ws_action("send_message", SendMessageActionSchema, order_key=by_group)
+async def send_message(conn: ActionDispatcher, payload: SendMessageActionSchema) -> Optional[dict]:
+    message, created = await run_db(_send_message, conn.user_id, payload.group_id, payload.text,
+                                    payload.idempotency_key, payload.attachment_id)
+    if not created:
+        # a retry: only the sender hears about it, the group already got the original
+        return {"event": "message", "message": message, "duplicate": True}
+    typing_tracker.clear(conn.user_id, payload.group_id)
+    append_recent(message)
+    reached = await manager.broadcast_to_group(payload.group_id, {"event": "message", "message": message})
+    offline_queue.record(message, reached)
+
+
+def message_window(db: Session, group_id: int, limit: int, before_id: Optional[int]) -> List[dict]:
+    boundary = message_archive.boundary(group_id)
+    items: List[dict] = []
+    if not before_id or before_id > boundary + 1:
+        items = [msg_to_dict(x) for x in fetch_message_page(db, group_id, limit, before_id)]
+    if boundary and len(items) < limit:
+        oldest_id = items[0]["id"] if items else before_id
+        items = message_archive.read_before(group_id, oldest_id, limit - len(items)) + items
+    return items
+
+
+def _fetch_messages(db: Session, user_id: int, group_id: int, limit: int, before_id: Optional[int]) -> List[dict]:
+    if not is_member(db, group_id, user_id):
+        raise ActionError("not a member")
+    return message_window(db, group_id, limit, before_id)
+
+
+@ws_action("fetch_messages", FetchMessagesActionSchema, read_only=True)
+async def fetch_messages(conn: ActionDispatcher, payload: FetchMessagesActionSchema) -> dict:
+    limit = min(payload.limit, 200)
+    if not payload.before_id and conn.user_id in await cached_member_ids(payload.group_id):
+        items = await latest_page(payload.group_id, limit)
+        if items is not None:
+            return {"event": "messages", "group_id": payload.group_id, "items": items}
+
+    items = await run_db(_fetch_messages, conn.user_id, payload.group_id,
+                         limit, payload.before_id or None, read_for=conn.user_id)
+    return {"event": "messages", "group_id": payload.group_id, "items": items}
+
+
+@ws_action("typing", TypingActionSchema, read_only=True)
+async def typing(conn: ActionDispatcher, payload: TypingActionSchema) -> None:
+    if conn.user_id not in await cached_member_ids(payload.group_id):
+        raise ActionError("not a member")
+    await typing_tracker.update(conn.user_id, payload.group_id, payload.typing)
+
+
+def _sync(db: Session, user_id: int, since_id: int, cursors: Dict[int, int],
+          groups_since: Optional[datetime], limit: int) -> dict:
+    server_time = datetime.utcnow()
+    rows = (
+        db.query(ChatGroup, GroupPeople.joined_date)
+        .join(GroupPeople, GroupPeople.group_id == ChatGroup.id)
+        .filter(GroupPeople.user_id == user_id)
+        .order_by(ChatGroup.id.desc())
+        .all()
+    )
+    group_ids = [g.id for g, _ in rows]
+    changed = [group_to_dict(g) for g, joined in rows
+               if groups_since is None or g.updated_date > groups_since or joined > groups_since]
+
+    # the global since_id doubles as the page cursor, so per-group cursors never go below it
+    floors = {gid: max(cursors.get(gid, since_id), since_id) for gid in group_ids}
+    messages: List[ChatMessage] = []
+    if floors:
+        by_floor: Dict[int, List[int]] = {}
+        for gid, floor in floors.items():
+            by_floor.setdefault(floor, []).append(gid)
+        q = db.query(ChatMessage).filter(or_(*(
+            and_(ChatMessage.group_id.in_(gids), ChatMessage.id > floor) for floor, gids in by_floor.items()
+        )))
+
+        lowest = min(floors.values())
+        cursor_date = db.query(ChatMessage.created_date).filter(ChatMessage.id == lowest).scalar() if lowest else None
+        if cursor_date is not None:
+            q = q.filter(ChatMessage.created_date >= cursor_date - timedelta(minutes=1))
+        messages = q.order_by(ChatMessage.id).limit(limit + 1).all()
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return {
+        "event": "sync",
+        "groups": changed,
+        "group_ids": group_ids,
+        "messages": [msg_to_dict(m) for m in messages],
+        "cursor": messages[-1].id if messages else since_id,
+        "has_more": has_more,
+        "server_time": server_time.isoformat(),
+    }
+
+
+@ws_action("sync", SyncActionSchema, read_only=True)
+async def sync(conn: ActionDispatcher, payload: SyncActionSchema) -> dict:
+    return await run_db(_sync, conn.user_id, payload.since_id, payload.cursors, payload.groups_since,
+                        min(payload.limit, WS_SYNC_MAX_MESSAGES), read_for=conn.user_id)
+
+
+def _fetch_latest(db: Session, user_id: int, group_ids: List[int], limit: int) -> Dict[int, List[dict]]:
+    return {gid: [msg_to_dict(m) for m in rows]
+            for gid, rows in latest_messages(db, user_id, group_ids, limit).items()}
+
+
+@ws_action("fetch_latest", FetchLatestActionSchema, read_only=True)
+async def fetch_latest(conn: ActionDispatcher, payload: FetchLatestActionSchema) -> dict:
+    groups = await run_db(_fetch_latest, conn.user_id, payload.group_ids, min(payload.limit, 100),
+                          read_for=conn.user_id)
+    return {"event": "latest", "groups": groups}
+
+
+@chat_router.websocket("/ws/chat")
+async def chat_ws(websocket: WebSocket, token: Optional[str] = Query(default=None),
+                  batch: bool = Query(default=False)):
+    user_id: Optional[int] = None
+    dispatcher: Optional[ActionDispatcher] = None
+
+    if manager.draining:
+        await turn_away(websocket, "draining", SERVICE_RESTART)
+        return
+    if not admission.acquire():
+        await turn_away(websocket, "rate_limited", TRY_AGAIN_LATER)
+        return
+
+    try:
+        tok = _extract_token(websocket, token)
+        if not tok:
+            await accept(websocket)
+            await send_event(websocket, {"event": "error", "detail": "Missing token"})
+            await websocket.close(code=1008)
+            return
+
+        db = SessionLocal()
+        try:
+            user = get_user_from_token(db, tok)
+            user_id, username = user.id, user.username
+        except ValueError:
+            await accept(websocket)
+            await send_event(websocket, {"event": "error", "detail": "Invalid token"})
+            await websocket.close(code=1008)
+            return
+        finally:
+            db.close()
+
+        await manager.connect(user_id, websocket, batch=batch)
+        group_ids = await run_db(user_group_ids, user_id)
+        manager.join_rooms(user_id, websocket, group_ids)
+        await warm_members(group_ids)
+        await send_event(websocket, {"event": "connected", "user_id": user_id, "username": username,
+                                     "batch": batch, "heartbeat_ms": manager.heartbeat_ms(websocket)})
+        digests = offline_queue.take(user_id)
+        if digests:
+            await send_event(websocket, {"event": "digest", "groups": digests})
+        bus.publish('user_online', user_id=user_id)
+
+        dispatcher = ActionDispatcher(websocket, user_id, username)
+        while True:
+            try:
+                data: Dict[str, Any] = await receive_event(websocket)
+            except ValueError as exc:
+                manager.touch(websocket)
+                await send_error(websocket, None, str(exc))
+                continue
+            manager.touch(websocket)
+            if isinstance(data, dict) and data.get("action") == "pong":
+                continue
+            await dispatcher.submit(data)
 
     except WebSocketDisconnect:
         pass
     finally:
-        if user is not None:
-            manager.disconnect(user.id, websocket)
-        db.close()
\ No newline at end of file
+        if dispatcher is not None:
+            await dispatcher.close()
+        if user_id is not None:
+            manager.disconnect(user_id, websocket)
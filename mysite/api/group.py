@@ -1,13 +1,22 @@
-from fastapi import HTTPException, Depends, APIRouter
+from fastapi import HTTPException, Depends, APIRouter, Request, Response, BackgroundTasks, Query
+from fastapi.responses import ORJSONResponse
 from mysite.database.models import ChatGroup, UserProfile, StatusChoices, ChatMessage, GroupPeople
 from mysite.database.schema import ChatGroupCreateSchema, ChatGroupOutSchema, ChatMessageOutSchema
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session, primary_pinned, use_primary
+from mysite.database.archive import message_archive
+from mysite.database.purge import delete_group
+from mysite.cache import response_cache, cached_response, invalidate_members, invalidate_recent
+from mysite.etag import (make_etag, etag_matches, not_modified, set_cache_headers,
+                         stats_columns, rows_stats)
+from mysite.serialize import schema_columns, dump_rows
+from mysite.api.chat_wb import manager, latest_page, message_window
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -18,7 +27,7 @@ group_router = APIRouter(prefix='/group', tags=['Chat Group'])
 
 
 def check_group_owner(group_id: int, user_id: int, db: Session):
-    group = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+    group = db.query(ChatGroup).filter(ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
@@ -32,6 +41,19 @@ def check_group_owner(group_id: int, user_id: int, db: Session):
     return group
 
 
+def group_detail_etag(group_id: int, db: Session) -> Optional[str]:
+    message_stats = [db.query(column).filter(ChatMessage.group_id == ChatGroup.id).scalar_subquery()
+                     for column in stats_columns(ChatMessage)]
+    people_count = db.query(func.count(GroupPeople.id)).filter(
+        GroupPeople.group_id == ChatGroup.id).scalar_subquery()
+
+    row = db.query(ChatGroup.id, ChatGroup.version, *message_stats, people_count).filter(
+        ChatGroup.id == group_id).first()
+    if not row:
+        return None
+    return make_etag('group_detail', *row)
+
+
 @group_router.post('/', response_model=dict)
 async def group_create(group: ChatGroupCreateSchema, db: Session = Depends(get_db)):
     owner = db.query(UserProfile).filter(UserProfile.id == group.owner_id).first()
@@ -42,30 +64,81 @@ async def group_create(group: ChatGroupCreateSchema, db: Session = Depends(get_d
     db.add(group_db)
     db.commit()
     db.refresh(group_db)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', group_db.owner_id)
     return {'message': 'Saved'}
 
 
 @group_router.get('/', response_model=List[ChatGroupOutSchema])
-async def group_list(db: Session = Depends(get_db)):
-    return db.query(ChatGroup).all()
+async def group_list(request: Request, db: Session = Depends(get_db)):
+    bypass = primary_pinned(request)
+    cached = None if bypass else await response_cache.get('group_list')
+    if cached is None:
+        groups = use_primary(db).query(
+            *schema_columns(ChatGroup, ChatGroupOutSchema, ChatGroup.updated_date)).filter(
+            ChatGroup.deleted_date.is_(None)).all()
+        cached = await response_cache.set(
+            'group_list',
+            content=dump_rows(ChatGroupOutSchema, groups),
+            etag=make_etag('group_list', *rows_stats(groups)),
+            store=not bypass
+        )
+    return cached_response(request, cached)
 
 
 @group_router.get('/{group_id}', response_model=Dict[str, Any])
-async def group_detail(group_id: int, db: Session = Depends(get_db)):
-    group_db = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+async def group_detail(group_id: int, request: Request, limit: Optional[int] = Query(default=None, ge=1, le=200),
+                       before_id: Optional[int] = Query(default=None, ge=1), db: Session = Depends(get_db)):
+    if limit is not None or before_id is not None:
+        return await group_head(group_id, limit or 50, before_id, db)
+
+    if 'if-none-match' in request.headers:
+        etag = group_detail_etag(group_id, db)
+        if etag and etag_matches(request, etag):
+            return not_modified(etag)
+
+    group_db = db.query(*schema_columns(ChatGroup, ChatGroupOutSchema, ChatGroup.version)).filter(
+        ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group_db:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
-    messages = db.query(ChatMessage).filter(ChatMessage.group_id == group_id).all()
+    messages = db.query(*schema_columns(ChatMessage, ChatMessageOutSchema, ChatMessage.updated_date)).filter(
+        ChatMessage.group_id == group_id).all()
 
     people_count = db.query(GroupPeople).filter(GroupPeople.group_id == group_id).count()
 
-    return {
-        'group': ChatGroupOutSchema.from_orm(group_db),
-        'messages': [ChatMessageOutSchema.from_orm(msg) for msg in messages],
-        'people_count': people_count
+    # archived history stays on disk; clients page into it with ?before_id=
+    response = ORJSONResponse({
+        'group': dump_rows(ChatGroupOutSchema, [group_db])[0],
+        'messages': dump_rows(ChatMessageOutSchema, messages),
+        'people_count': people_count,
+        'archived_until': message_archive.boundary(group_id)
+
+    })
+    set_cache_headers(response, make_etag('group_detail', group_db.id, group_db.version,
+                                          *rows_stats(messages), people_count))
+    return response
+
+
+async def group_head(group_id: int, limit: int, before_id: Optional[int], db: Session):
+    # one page of messages: the newest usually straight from the recent-message buffer, older
+    # ones from the table, and from archive segments only once before_id crosses the boundary
+    group_db = db.query(*schema_columns(ChatGroup, ChatGroupOutSchema)).filter(
+        ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
+    if not group_db:
+        raise HTTPException(status_code=404, detail='Группа табылган жок')
 
-    }
+    messages = None if before_id else await latest_page(group_id, limit)
+    if messages is None:
+        messages = message_window(db, group_id, limit, before_id)
+
+    people_count = db.query(GroupPeople).filter(GroupPeople.group_id == group_id).count()
+    return ORJSONResponse({
+        'group': dump_rows(ChatGroupOutSchema, [group_db])[0],
+        'messages': messages,
+        'people_count': people_count
+    })
 
 
 @group_router.put('/{group_id}', response_model=ChatGroupOutSchema)
@@ -77,28 +150,65 @@ async def group_update(group_id: int, group: ChatGroupCreateSchema,
     if not owner:
         raise HTTPException(status_code=404, detail='Ээси табылган жок')
 
+    old_owner_id = group_db.owner_id
     for group_key, group_value in group.dict().items():
         setattr(group_db, group_key, group_value)
 
     db.add(group_db)
     db.commit()
     db.refresh(group_db)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', old_owner_id)
+    await response_cache.invalidate('groups_by_owner', group_db.owner_id)
     return group_db
 
 
 @group_router.delete('/{group_id}')
-async def group_delete(group_id: int, current_user_id: int, db: Session = Depends(get_db)):
+async def group_delete(group_id: int, current_user_id: int, response: Response,
+                       background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     group_db = check_group_owner(group_id, current_user_id, db)
-
-    db.delete(group_db)
-    db.commit()
+    owner_id = group_db.owner_id
+
+    deferred = delete_group(db, group_db, background_tasks.add_task)
+
+    await response_cache.invalidate('group_list')
+    await response_cache.invalidate('groups_by_owner', owner_id)
+    await invalidate_members(group_id)
+    manager.drop_group(group_id)
+    invalidate_recent(group_id)
+    if deferred:
+        response.status_code = 202
+        return {'message': 'Deleting'}
     return {'message': 'Deleted'}
 
 
 @group_router.get('/owner/{owner_id}', response_model=List[ChatGroupOutSchema])
-async def groups_by_owner(owner_id: int, db: Session = Depends(get_db)):
-    owner = db.query(UserProfile).filter(UserProfile.id == owner_id).first()
+async def groups_by_owner(owner_id: int, request: Request, db: Session = Depends(get_db)):
+    bypass = primary_pinned(request)
+    cached = None if bypass else await response_cache.get('groups_by_owner', owner_id)
+    if cached is not None:
+        return cached_response(request, cached)
+
+    if 'if-none-match' in request.headers:
+        row = db.query(UserProfile.id, *stats_columns(ChatGroup)).outerjoin(
+            ChatGroup, ChatGroup.owner_id == UserProfile.id
+        ).filter(UserProfile.id == owner_id).group_by(UserProfile.id).first()
+        if row:
+            etag = make_etag('groups_by_owner', *row)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    owner = use_primary(db).query(UserProfile).filter(UserProfile.id == owner_id).first()
     if not owner:
         raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
 
-    return db.query(ChatGroup).filter(ChatGroup.owner_id == owner_id).all()
\ No newline at end of file
+    groups = db.query(*schema_columns(ChatGroup, ChatGroupOutSchema, ChatGroup.updated_date)).filter(
+        ChatGroup.owner_id == owner_id, ChatGroup.deleted_date.is_(None)).all()
+    cached = await response_cache.set(
+        'groups_by_owner', owner_id,
+        content=dump_rows(ChatGroupOutSchema, groups),
+        etag=make_etag('groups_by_owner', owner_id, *rows_stats(groups)),
+        store=not bypass
+    )
+    return cached_response(request, cached)
@@ -1,13 +1,21 @@
-from fastapi import HTTPException, Depends, APIRouter
+from fastapi import HTTPException, Depends, APIRouter, Request, Response, Query
+from fastapi.responses import ORJSONResponse
 from mysite.database.models import ChatMessage, ChatGroup, UserProfile, GroupPeople
 from mysite.database.schema import ChatMessageCreateSchema, ChatMessageOutSchema
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session
+from mysite.database.history import latest_messages
+from mysite.database.idempotency import create_message, IdempotencyConflict
+from mysite.serialize import schema_columns, dump_rows, rows_response
+from mysite.etag import make_etag, etag_matches, not_modified, set_cache_headers
+from mysite.cache import invalidate_recent
+from mysite.api.attachment import readable_attachment
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Dict, List, Optional
+from datetime import datetime
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -34,26 +42,55 @@ async def message_create(message: ChatMessageCreateSchema, db: Session = Depends
     if not is_member:
         raise HTTPException(status_code=403, detail='Колдонуучу группага мүчө эмес')
 
-    if not message.text or message.text.strip() == '':
+    if message.text.strip() == '' and message.attachment_id is None:
         raise HTTPException(status_code=400, detail='Билдирүү бош болбошу керек')
 
-    message_db = ChatMessage(**message.dict())
-    db.add(message_db)
-    db.commit()
-    db.refresh(message_db)
-    return {'message': 'Saved'}
+    if message.attachment_id is not None:
+        if not readable_attachment(db, message.attachment_id, message.user_id):
+            raise HTTPException(status_code=404, detail='Файл табылган жок')
+
+    try:
+        message_db, created = create_message(db, message.group_id, message.user_id, message.text,
+                                             message.idempotency_key, message.attachment_id)
+    except IdempotencyConflict:
+        raise HTTPException(status_code=409, detail='Бул ачкыч башка билдирүү үчүн колдонулган')
+    if created:
+        invalidate_recent(message.group_id)
+    return {'message': 'Saved', 'id': message_db.id}
 
 
 @message_router.get('/', response_model=List[ChatMessageOutSchema])
-async def message_list(db: Session = Depends(get_db)):
-    return db.query(ChatMessage).all()
+async def message_list(created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                       db: Session = Depends(get_db)):
+    q = db.query(*schema_columns(ChatMessage, ChatMessageOutSchema))
+    if created_from:
+        q = q.filter(ChatMessage.created_date >= created_from)
+    if created_to:
+        q = q.filter(ChatMessage.created_date < created_to)
+    return rows_response(ChatMessageOutSchema, q.all())
+
+
+@message_router.get('/latest', response_model=Dict[int, List[ChatMessageOutSchema]])
+async def message_latest(user_id: int, group_ids: List[int] = Query(default=[]),
+                         limit: int = Query(default=20, ge=1, le=100), db: Session = Depends(get_db)):
+    return ORJSONResponse({gid: dump_rows(ChatMessageOutSchema, rows)
+                           for gid, rows in latest_messages(db, user_id, group_ids, limit).items()})
 
 
 @message_router.get('/{message_id}', response_model=ChatMessageOutSchema)
-async def message_detail(message_id: int, db: Session = Depends(get_db)):
+async def message_detail(message_id: int, request: Request, response: Response,
+                         db: Session = Depends(get_db)):
+    if 'if-none-match' in request.headers:
+        row = db.query(ChatMessage.id, ChatMessage.version).filter(ChatMessage.id == message_id).first()
+        if row:
+            etag = make_etag('message', row.id, row.version)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
     message_db = db.query(ChatMessage).filter(ChatMessage.id == message_id).first()
     if not message_db:
         raise HTTPException(status_code=404, detail='Билдирүү табылган жок')
+    set_cache_headers(response, make_etag('message', message_db.id, message_db.version))
     return message_db
 
 
@@ -64,8 +101,10 @@ async def message_delete(message_id: int, db: Session = Depends(get_db)):
     if message_db is None:
         raise HTTPException(status_code=404, detail='Андай маалымат жок')
 
+    group_id = message_db.group_id
     db.delete(message_db)
     db.commit()
+    invalidate_recent(group_id)
     return {'message': 'Deleted'}
 
 
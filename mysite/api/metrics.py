@@ -0,0 +1,9 @@
+from fastapi import APIRouter, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+metrics_router = APIRouter(tags=['Metrics'])
+
+
+@metrics_router.get('/metrics', include_in_schema=False)
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,13 +1,17 @@
-from fastapi import HTTPException, Depends, APIRouter
+from fastapi import HTTPException, Depends, APIRouter, Request
 from mysite.database.models import GroupPeople, ChatGroup, UserProfile, StatusChoices
 from mysite.database.schema import GroupPeopleCreateSchema, GroupPeopleOutSchema
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session, primary_pinned, use_primary
+from mysite.cache import response_cache, cached_response, invalidate_members
+from mysite.etag import make_etag, etag_matches, not_modified, stats_columns, rows_stats
+from mysite.serialize import schema_columns, dump_rows, rows_response
+from mysite.api.chat_wb import manager
 from sqlalchemy.orm import Session
 from typing import List
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -18,7 +22,7 @@ people_router = APIRouter(prefix='/people', tags=['Group People'])
 
 
 def check_add_permission(group_id: int, current_user_id: int, db: Session):
-    group = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+    group = db.query(ChatGroup).filter(ChatGroup.id == group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
@@ -47,12 +51,15 @@ async def people_create(people: GroupPeopleCreateSchema, db: Session = Depends(g
     db.add(people_db)
     db.commit()
     db.refresh(people_db)
+
+    await invalidate_members(people_db.group_id)
+    manager.join_group(people_db.group_id, [people_db.user_id])
     return {'message': 'Saved'}
 
 
 @people_router.get('/', response_model=List[GroupPeopleOutSchema])
 async def people_list(db: Session = Depends(get_db)):
-    return db.query(GroupPeople).all()
+    return rows_response(GroupPeopleOutSchema, db.query(*schema_columns(GroupPeople, GroupPeopleOutSchema)).all())
 
 
 @people_router.get('/{people_id}', response_model=GroupPeopleOutSchema)
@@ -72,7 +79,7 @@ async def people_update(people_id: int, people: GroupPeopleCreateSchema,
 
     check_add_permission(people.group_id, current_user_id, db)
 
-    group = db.query(ChatGroup).filter(ChatGroup.id == people.group_id).first()
+    group = db.query(ChatGroup).filter(ChatGroup.id == people.group_id, ChatGroup.deleted_date.is_(None)).first()
     if not group:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
@@ -80,12 +87,18 @@ async def people_update(people_id: int, people: GroupPeopleCreateSchema,
     if not user:
         raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
 
+    old_group_id, old_user_id = people_db.group_id, people_db.user_id
     for people_key, people_value in people.dict().items():
         setattr(people_db, people_key, people_value)
 
     db.add(people_db)
     db.commit()
     db.refresh(people_db)
+
+    await invalidate_members(old_group_id)
+    await invalidate_members(people_db.group_id)
+    manager.leave_group(old_group_id, [old_user_id])
+    manager.join_group(people_db.group_id, [people_db.user_id])
     return people_db
 
 
@@ -110,16 +123,42 @@ async def people_delete(people_id: int, current_user_id: int, db: Session = Depe
 
     db.delete(people_db)
     db.commit()
+
+    await invalidate_members(people_db.group_id)
+    manager.leave_group(people_db.group_id, [people_db.user_id])
     return {'message': 'Deleted'}
 
 
 @people_router.get('/group/{group_id}', response_model=List[GroupPeopleOutSchema])
-async def people_by_group(group_id: int, db: Session = Depends(get_db)):
-    group = db.query(ChatGroup).filter(ChatGroup.id == group_id).first()
+async def people_by_group(group_id: int, request: Request, db: Session = Depends(get_db)):
+    bypass = primary_pinned(request)
+    cached = None if bypass else await response_cache.get('people_by_group', group_id)
+    if cached is not None:
+        return cached_response(request, cached)
+
+    if 'if-none-match' in request.headers:
+        row = db.query(ChatGroup.id, *stats_columns(GroupPeople)).outerjoin(
+            GroupPeople, GroupPeople.group_id == ChatGroup.id
+        ).filter(ChatGroup.id == group_id).group_by(ChatGroup.id).first()
+        if row:
+            etag = make_etag('people_by_group', *row)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    group = use_primary(db).query(ChatGroup).filter(ChatGroup.id == group_id,
+                                                    ChatGroup.deleted_date.is_(None)).first()
     if not group:
         raise HTTPException(status_code=404, detail='Группа табылган жок')
 
-    return db.query(GroupPeople).filter(GroupPeople.group_id == group_id).all()
+    people = db.query(*schema_columns(GroupPeople, GroupPeopleOutSchema, GroupPeople.updated_date)).filter(
+        GroupPeople.group_id == group_id).all()
+    cached = await response_cache.set(
+        'people_by_group', group_id,
+        content=dump_rows(GroupPeopleOutSchema, people),
+        etag=make_etag('people_by_group', group_id, *rows_stats(people)),
+        store=not bypass
+    )
+    return cached_response(request, cached)
 
 
 @people_router.get('/user/{user_id}', response_model=List[GroupPeopleOutSchema])
@@ -128,4 +167,5 @@ async def groups_by_user(user_id: int, db: Session = Depends(get_db)):
     if not user:
         raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
 
-    return db.query(GroupPeople).filter(GroupPeople.user_id == user_id).all()
+    people = db.query(*schema_columns(GroupPeople, GroupPeopleOutSchema)).filter(GroupPeople.user_id == user_id).all()
+    return rows_response(GroupPeopleOutSchema, people)
@@ -1,13 +1,18 @@
-from fastapi import HTTPException, Depends, APIRouter
-from mysite.database.models import UserProfile, StatusChoices
+from fastapi import HTTPException, Depends, APIRouter, Request
+from mysite.database.models import UserProfile, StatusChoices, ChatGroup
 from mysite.database.schema import UserProfileCreateSchema, UserProfileOutSchema, UserProfileLoginSchema
-from mysite.database.db import SessionLocal
+from mysite.database.db import request_session, primary_pinned, use_primary
+from mysite.cache import response_cache, cached_response, invalidate_user
+from mysite.database.archive import message_archive
+from mysite.etag import make_etag, etag_matches, not_modified
+from mysite.serialize import schema_columns, rows_response
+from mysite.api.chat_wb import manager
 from sqlalchemy.orm import Session
 from typing import List
 
 
-async def get_db():
-    db = SessionLocal()
+async def get_db(request: Request):
+    db = request_session(request)
     try:
         yield db
     finally:
@@ -51,15 +56,33 @@ async def user_create(user: UserProfileCreateSchema, db: Session = Depends(get_d
 
 @user_router.get('/', response_model=List[UserProfileOutSchema])
 async def user_list(db: Session = Depends(get_db)):
-    return db.query(UserProfile).all()
+    return rows_response(UserProfileOutSchema, db.query(*schema_columns(UserProfile, UserProfileOutSchema)).all())
 
 
 @user_router.get('/{user_id}', response_model=UserProfileOutSchema)
-async def user_detail(user_id: int, db: Session = Depends(get_db)):
-    user_db = db.query(UserProfile).filter(UserProfile.id == user_id).first()
+async def user_detail(user_id: int, request: Request, db: Session = Depends(get_db)):
+    bypass = primary_pinned(request)
+    cached = None if bypass else await response_cache.get('user_detail', user_id)
+    if cached is not None:
+        return cached_response(request, cached)
+
+    if 'if-none-match' in request.headers:
+        row = db.query(UserProfile.id, UserProfile.version).filter(UserProfile.id == user_id).first()
+        if row:
+            etag = make_etag('user', row.id, row.version)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    user_db = use_primary(db).query(UserProfile).filter(UserProfile.id == user_id).first()
     if not user_db:
         raise HTTPException(status_code=404, detail='Колдонуучу табылган жок')
-    return user_db
+    cached = await response_cache.set(
+        'user_detail', user_id,
+        content=UserProfileOutSchema.model_validate(user_db).model_dump(mode='json'),
+        etag=make_etag('user', user_db.id, user_db.version),
+        store=not bypass
+    )
+    return cached_response(request, cached)
 
 
 @user_router.put('/{user_id}', response_model=UserProfileOutSchema)
@@ -77,6 +100,8 @@ async def user_update(user_id: int, user: UserProfileCreateSchema,
     db.add(user_db)
     db.commit()
     db.refresh(user_db)
+
+    await response_cache.invalidate('user_detail', user_id)
     return user_db
 
 
@@ -88,8 +113,15 @@ async def user_delete(user_id: int, current_user_id: int, db: Session = Depends(
 
     check_owner(user_id, current_user_id, db)
 
+    owned = [r[0] for r in db.query(ChatGroup.id).filter(ChatGroup.owner_id == user_id).all()]
     db.delete(user_db)
     db.commit()
+
+    # the owned groups went with the cascade; their archive segments have to go by hand
+    for group_id in owned:
+        message_archive.drop_group(group_id)
+    await invalidate_user(user_id)
+    manager.forget_user(user_id, owned)
     return {'message': 'Deleted'}
 
 
@@ -120,4 +152,6 @@ async def change_user_status(user_id: int, new_status: StatusChoices,
     db.add(user_db)
     db.commit()
     db.refresh(user_db)
+
+    await response_cache.invalidate('user_detail', user_id)
     return user_db
@@ -0,0 +1,39 @@
+import random
+import time
+from mysite.config import WS_ADMIT_PER_SECOND, WS_ADMIT_BURST, WS_RECONNECT_JITTER_MS
+
+# close codes the client should answer by reconnecting after the hinted delay
+SERVICE_RESTART = 1012
+TRY_AGAIN_LATER = 1013
+
+
+class AdmissionLimiter:
+    # token bucket per worker: bursts up to `burst` new sockets, refilled at `rate` per second;
+    # it only runs on the event loop, so it needs no lock
+    def __init__(self, rate: float = WS_ADMIT_PER_SECOND, burst: int = WS_ADMIT_BURST) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def acquire(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+admission = AdmissionLimiter()
+
+
+def reconnect_event(delay: float) -> dict:
+    return {"event": "reconnect", "retry_after_ms": int(delay * 1000)}
+
+
+def retry_delay(window_ms: int = WS_RECONNECT_JITTER_MS) -> float:
+    return random.uniform(0, window_ms) / 1000
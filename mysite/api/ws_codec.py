@@ -0,0 +1,180 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Union
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+from mysite.config import WS_BATCH_DELAY_MS, WS_BATCH_MAX_EVENTS
+from mysite.metrics import WS_BATCH_SIZE
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def encode(self, payload: Any) -> str:
+        return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+    def decode(self, message: dict) -> Any:
+        text = message.get('text')
+        return json.loads(text if text is not None else message['bytes'])
+
+    def encode_batch(self, items: List[str]) -> str:
+        return '{"event":"batch","items":[' + ','.join(items) + ']}'
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, payload: Any) -> bytes:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, message: dict) -> Any:
+        data = message.get('bytes')
+        return msgpack.unpackb(data if data is not None else message['text'].encode(), raw=False)
+
+    def encode_batch(self, items: List[bytes]) -> bytes:
+        # already-encoded events are spliced into the array without re-packing them
+        packer = msgpack.Packer(use_bin_type=True)
+        return (packer.pack_map_header(2) + packer.pack('event') + packer.pack('batch')
+                + packer.pack('items') + packer.pack_array_header(len(items)) + b''.join(items))
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+DEFAULT_CODEC = CODECS['json']
+
+Codec = Union[JsonCodec, MsgpackCodec]
+
+
+class EncodedEvent:
+    def __init__(self, payload: dict) -> None:
+        self.payload = payload
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+
+    def encode(self, codec: Codec) -> Union[str, bytes]:
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = self._encoded[codec.name] = codec.encode(self.payload)
+        return data
+
+
+class EventBatcher:
+    def __init__(self, websocket: WebSocket, codec: Codec, delay_ms: int = WS_BATCH_DELAY_MS,
+                 max_events: int = WS_BATCH_MAX_EVENTS) -> None:
+        self.websocket = websocket
+        self.codec = codec
+        self.delay = delay_ms / 1000
+        self.max_events = max_events
+        self.closed = False
+        self._pending: List[Union[str, bytes]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def add(self, data: Union[str, bytes]) -> None:
+        if self.closed:
+            raise RuntimeError('websocket is closed')
+        self._pending.append(data)
+        if len(self._pending) >= self.max_events:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._flush_later)
+
+    def _flush_later(self) -> None:
+        self._timer = None
+        self._flush_task = asyncio.create_task(self._flush_quietly())
+
+    async def _flush_quietly(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            # the next add() raises, so the manager drops this socket
+            self.closed = True
+
+    async def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        items, self._pending = self._pending, []
+        WS_BATCH_SIZE.observe(len(items))
+        await send_raw(self.websocket, self.codec, items[0] if len(items) == 1 else self.codec.encode_batch(items))
+
+    def close(self) -> None:
+        self.closed = True
+        self._pending = []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+# offered next to (or instead of) a codec by clients that answer {"event": "ping"} with
+# {"action": "pong"}; everyone else is kept alive by the server's protocol-level pings
+HEARTBEAT_SUBPROTOCOL = 'heartbeat'
+
+
+def negotiate(websocket: WebSocket) -> Optional[str]:
+    offered = websocket.scope.get('subprotocols', [])
+    for subprotocol in offered:
+        if subprotocol in CODECS:
+            return subprotocol
+    # a client that offered protocols must get one of them back
+    return HEARTBEAT_SUBPROTOCOL if HEARTBEAT_SUBPROTOCOL in offered else None
+
+
+def wants_heartbeat(websocket: WebSocket) -> bool:
+    return HEARTBEAT_SUBPROTOCOL in websocket.scope.get('subprotocols', [])
+
+
+def codec_for(websocket: WebSocket) -> Codec:
+    return getattr(websocket.state, 'codec', DEFAULT_CODEC)
+
+
+async def accept(websocket: WebSocket, batch: bool = False) -> None:
+    subprotocol = negotiate(websocket)
+    websocket.state.codec = CODECS.get(subprotocol, DEFAULT_CODEC)
+    if batch:
+        websocket.state.batcher = EventBatcher(websocket, websocket.state.codec)
+    await websocket.accept(subprotocol=subprotocol)
+
+
+def close_batcher(websocket: WebSocket) -> None:
+    batcher = getattr(websocket.state, 'batcher', None)
+    if batcher is not None:
+        batcher.close()
+
+
+async def close_socket(websocket: WebSocket, code: int) -> None:
+    # batched events still waiting for their timer go out before the close frame
+    batcher = getattr(websocket.state, 'batcher', None)
+    if batcher is not None and not batcher.closed:
+        await batcher.flush()
+        batcher.close()
+    await websocket.close(code=code)
+
+
+async def send_raw(websocket: WebSocket, codec: Codec, data: Union[str, bytes]) -> None:
+    if codec.binary:
+        await websocket.send_bytes(data)
+    else:
+        await websocket.send_text(data)
+
+
+async def send_event(websocket: WebSocket, event: Union[dict, EncodedEvent]) -> None:
+    codec = codec_for(websocket)
+    data = event.encode(codec) if isinstance(event, EncodedEvent) else codec.encode(event)
+    batcher = getattr(websocket.state, 'batcher', None)
+    if batcher is not None:
+        await batcher.add(data)
+    else:
+        await send_raw(websocket, codec, data)
+
+
+async def receive_event(websocket: WebSocket) -> Any:
+    message = await websocket.receive()
+    if message['type'] == 'websocket.disconnect':
+        raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+    try:
+        return codec_for(websocket).decode(message)
+    except Exception as exc:
+        raise ValueError(f'invalid {codec_for(websocket).name} frame') from exc
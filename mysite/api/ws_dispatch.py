@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Type
+from fastapi import WebSocket
+from pydantic import BaseModel, ValidationError
+from mysite.config import WS_MAX_INFLIGHT, WS_CLOSE_GRACE_SECONDS
+from mysite.database.db import start_query_scope, finish_query_scope
+from mysite.database.routing import sticky_writers
+from mysite.metrics import WS_ACTION_ERRORS, observe_ws_action
+from mysite.api.ws_codec import send_event
+
+logger = logging.getLogger('mysite.ws')
+
+
+class ActionError(Exception):
+    def __init__(self, detail: str) -> None:
+        super().__init__(detail)
+        self.detail = detail
+
+
+class WsAction:
+    def __init__(self, name: str, handler: Callable[..., Awaitable[Optional[dict]]],
+                 schema: Type[BaseModel], order_key: Optional[Callable[[Any], Hashable]] = None,
+                 read_only: bool = False) -> None:
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.order_key = order_key
+        self.read_only = read_only
+
+
+WS_ACTIONS: Dict[str, WsAction] = {}
+
+
+def ws_action(name: str, schema: Type[BaseModel], order_key: Optional[Callable[[Any], Hashable]] = None,
+              read_only: bool = False):
+    def register(handler):
+        WS_ACTIONS[name] = WsAction(name, handler, schema, order_key, read_only)
+        return handler
+    return register
+
+
+def action_label(action: Any) -> str:
+    return action if isinstance(action, str) and action in WS_ACTIONS else 'unknown'
+
+
+def validation_detail(exc: ValidationError) -> str:
+    return '; '.join(f"{'.'.join(str(p) for p in err['loc']) or 'payload'}: {err['msg']}"
+                     for err in exc.errors())
+
+
+async def send_error(websocket: WebSocket, action: Any, detail: str, request_id: Any = None) -> None:
+    WS_ACTION_ERRORS.labels(action_label(action)).inc()
+    payload = {'event': 'error', 'action': action, 'detail': detail}
+    if request_id is not None:
+        payload['request_id'] = request_id
+    await send_event(websocket, payload)
+
+
+class ActionDispatcher:
+    def __init__(self, websocket: WebSocket, user_id: int, username: str,
+                 max_inflight: int = WS_MAX_INFLIGHT) -> None:
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+        self._tasks: Dict[asyncio.Task, WsAction] = {}
+        self._closing = False
+
+    async def submit(self, data: Any) -> None:
+        if not isinstance(data, dict):
+            await send_error(self.websocket, None, 'payload must be an object')
+            return
+
+        name = data.get('action')
+        request_id = data.get('request_id')
+        action = WS_ACTIONS.get(name) if isinstance(name, str) else None
+        if action is None:
+            await send_error(self.websocket, name, f'Unknown action: {name}', request_id)
+            return
+
+        try:
+            payload = action.schema.model_validate(data)
+        except ValidationError as exc:
+            await send_error(self.websocket, name, validation_detail(exc), request_id)
+            return
+
+        await self._inflight.acquire()
+        key = action.order_key(payload) if action.order_key else None
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._run(action, payload, request_id, previous))
+        self._tasks[task] = action
+        task.add_done_callback(lambda t: self._tasks.pop(t, None))
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda t: self._tails.pop(key) if self._tails.get(key) is t else None)
+
+    async def _run(self, action: WsAction, payload: BaseModel, request_id: Any,
+                   previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            if self._closing:
+                # queued behind an ordered write when the client left; it was never acked
+                return
+
+            started = time.perf_counter()
+            query_scope = start_query_scope(f'ws {action.name}')
+            try:
+                if not action.read_only:
+                    # later reads from this user go to the primary until replicas catch up
+                    sticky_writers.mark(('user', self.user_id))
+                response = await action.handler(self, payload)
+                if response is None and request_id is not None:
+                    response = {'event': 'ack', 'action': action.name}
+                if response is not None:
+                    if request_id is not None:
+                        response = {**response, 'request_id': request_id}
+                    await send_event(self.websocket, response)
+            except ActionError as exc:
+                await send_error(self.websocket, action.name, exc.detail, request_id)
+            except Exception:
+                logger.exception('ws action %s failed', action.name)
+                await send_error(self.websocket, action.name, 'internal error', request_id)
+            finally:
+                finish_query_scope(query_scope)
+                observe_ws_action(action.name, started)
+        except Exception:
+            # the socket went away while we were answering; the receive loop handles cleanup
+            pass
+        finally:
+            self._inflight.release()
+
+    async def close(self, grace: float = WS_CLOSE_GRACE_SECONDS) -> None:
+        # reads are dropped, but a write that already started may have committed: cancelling it
+        # would skip its broadcast and buffer update, so it gets `grace` seconds and is then
+        # left to finish on its own
+        self._closing = True
+        for task, action in list(self._tasks.items()):
+            if action.read_only:
+                task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=grace)
@@ -0,0 +1,188 @@
+import asyncio
+import importlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+from mysite.config import OFFLINE_NOTIFY_DELAY, OFFLINE_QUEUE_MAX_USERS, OFFLINE_NOTIFIER
+from mysite.metrics import WS_OFFLINE_USERS
+
+logger = logging.getLogger('mysite.ws')
+
+PREVIEW_LENGTH = 100
+
+
+class GroupDigest:
+    __slots__ = ('group_id', 'count', 'first_id', 'last_id', 'last_message')
+
+    def __init__(self, group_id: int) -> None:
+        self.group_id = group_id
+        self.count = 0
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+        self.last_message: Optional[dict] = None
+
+    def add(self, message: dict) -> None:
+        self.count += 1
+        if self.first_id is None:
+            self.first_id = message['id']
+        self.last_id = message['id']
+        self.last_message = {
+            'user_id': message['user_id'],
+            'text': message['text'][:PREVIEW_LENGTH],
+            'attachment_id': message.get('attachment_id'),
+            'created_date': message['created_date'],
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            'group_id': self.group_id,
+            'count': self.count,
+            'first_id': self.first_id,
+            'last_id': self.last_id,
+            'last_message': self.last_message,
+        }
+
+
+class LogNotifier:
+    # local stand-in for push/e-mail delivery
+    async def notify(self, user_id: int, digests: List[dict]) -> None:
+        logger.info('offline digest for user %s: %s', user_id,
+                    ', '.join(f"group {d['group_id']}: {d['count']}" for d in digests))
+
+
+def load_notifier(path: str = OFFLINE_NOTIFIER):
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)()
+
+
+Members = Callable[[int], Awaitable[FrozenSet[int]]]
+IsOnline = Callable[[int], bool]
+OnlineElsewhere = Callable[[Set[int]], Awaitable[Set[int]]]
+Deliver = Callable[[int, List[dict]], Awaitable[None]]
+
+
+class OfflineQueue:
+    # messages that reached no socket are folded into one digest per user and group;
+    # the digest goes out on reconnect, or to the notifier if the user stays away
+    def __init__(self, notifier, members: Members, is_online: IsOnline, elsewhere: OnlineElsewhere, deliver: Deliver,
+                 notify_delay: float = OFFLINE_NOTIFY_DELAY, max_users: int = OFFLINE_QUEUE_MAX_USERS) -> None:
+        self.notifier = notifier
+        self.members = members
+        self.is_online = is_online
+        self.elsewhere = elsewhere
+        self.deliver = deliver
+        self.notify_delay = notify_delay
+        self.max_users = max_users
+        self._digests: 'OrderedDict[int, Dict[int, GroupDigest]]' = OrderedDict()
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._pending: List[Tuple[dict, Set[int]]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def record(self, message: dict, reached: Set[int]) -> None:
+        # called from the broadcast path, so it only hands the work to the worker,
+        # which looks up who else is in the group
+        self._pending.append((message, reached))
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def take(self, user_id: int) -> List[dict]:
+        digests = self._digests.pop(user_id, None)
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        WS_OFFLINE_USERS.set(len(self._digests))
+        if not digests:
+            return []
+        return [d.to_dict() for d in digests.values()]
+
+    def close(self) -> None:
+        # digests still queued are dropped; their users catch up through sync
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._digests:
+            logger.info('dropping offline digests for %d users', len(self._digests))
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            pending, self._pending = self._pending, []
+            touched: Set[int] = set()
+            for message, reached in pending:
+                try:
+                    member_ids = await self.members(message['group_id'])
+                except Exception:
+                    logger.exception('offline digest skipped for group %s', message['group_id'])
+                    continue
+                missed = set(member_ids - reached)
+                if missed:
+                    # `reached` only covers this worker; users connected to another one got it there
+                    missed -= await self.elsewhere(missed)
+                for uid in missed:
+                    self._add(uid, message)
+                    touched.add(uid)
+            WS_OFFLINE_USERS.set(len(self._digests))
+
+            for uid in touched:
+                if self.is_online(uid):
+                    # reconnected between the broadcast and now: hand the digest over directly
+                    digests = self.take(uid)
+                    if digests:
+                        await self._call(self.deliver, uid, digests)
+                elif uid not in self._timers and uid in self._digests:
+                    self._timers[uid] = asyncio.get_running_loop().call_later(
+                        self.notify_delay, self._spawn_notify, uid)
+
+    def _add(self, user_id: int, message: dict) -> None:
+        groups = self._digests.get(user_id)
+        if groups is None:
+            groups = self._digests[user_id] = {}
+            if len(self._digests) > self.max_users:
+                # the evicted user still gets everything through sync, just without a digest
+                evicted, _ = self._digests.popitem(last=False)
+                timer = self._timers.pop(evicted, None)
+                if timer is not None:
+                    timer.cancel()
+        else:
+            self._digests.move_to_end(user_id)
+        digest = groups.get(message['group_id'])
+        if digest is None:
+            digest = groups[message['group_id']] = GroupDigest(message['group_id'])
+        digest.add(message)
+
+    def _spawn_notify(self, user_id: int) -> None:
+        self._timers.pop(user_id, None)
+        if user_id not in self._digests or self.is_online(user_id):
+            return
+        task = asyncio.create_task(self._notify(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self, user_id: int) -> None:
+        if await self.elsewhere({user_id}):
+            # came back on a worker that has not asked for this digest yet
+            digests = self.take(user_id)
+            if digests:
+                await self._call(self.deliver, user_id, digests)
+            return
+        groups = self._digests.get(user_id)
+        if not groups:
+            return
+        # the digest stays queued for reconnect; later messages arm a fresh notification
+        await self._call(self.notifier.notify, user_id, [d.to_dict() for d in groups.values()])
+
+    async def _call(self, fn: Callable[..., Awaitable[None]], user_id: int, digests: List[dict]) -> None:
+        try:
+            await fn(user_id, digests)
+        except Exception:
+            logger.exception('offline digest delivery failed for user %s', user_id)
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+from mysite.config import WS_TYPING_THROTTLE_MS, WS_TYPING_TTL_MS
+
+Publish = Callable[[int, int, bool], Awaitable[None]]
+
+
+class TypingState:
+    def __init__(self) -> None:
+        self.sent = False
+        self.last_sent = 0.0
+        self.flush: Optional[asyncio.TimerHandle] = None
+        self.expire: Optional[asyncio.TimerHandle] = None
+
+    def cancel(self) -> None:
+        for handle in (self.flush, self.expire):
+            if handle is not None:
+                handle.cancel()
+        self.flush = self.expire = None
+
+
+class TypingTracker:
+    # in-memory only: starts are throttled per user and group, stops go out at once,
+    # and a user who goes quiet for ttl_ms is stopped automatically
+    def __init__(self, publish: Publish, throttle_ms: int = WS_TYPING_THROTTLE_MS,
+                 ttl_ms: int = WS_TYPING_TTL_MS) -> None:
+        self.publish = publish
+        self.throttle = throttle_ms / 1000
+        self.ttl = ttl_ms / 1000
+        self._states: Dict[Tuple[int, int], TypingState] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def update(self, user_id: int, group_id: int, typing: bool) -> None:
+        key = (user_id, group_id)
+        state = self._states.get(key)
+        if state is None:
+            if not typing:
+                return
+            state = self._states[key] = TypingState()
+
+        loop = asyncio.get_running_loop()
+        state.cancel()
+        if not typing:
+            # keep the state for one window so stop/start flapping stays throttled
+            state.expire = loop.call_later(self.throttle, self._forget, key, state)
+            if state.sent:
+                await self._send(key, state, False)
+            return
+
+        state.expire = loop.call_later(self.ttl, self._spawn, user_id, group_id, False)
+        wait = state.last_sent + self.throttle - time.monotonic()
+        if wait > 0:
+            if not state.sent:
+                state.flush = loop.call_later(wait, self._spawn, user_id, group_id, True)
+            return
+        # a repeated start past the window refreshes receivers before their own expiry fires
+        await self._send(key, state, True)
+
+    def clear(self, user_id: int, group_id: int) -> None:
+        # the user's message ends the indicator on every client, so nothing needs sending
+        state = self._states.pop((user_id, group_id), None)
+        if state is not None:
+            state.cancel()
+
+    async def _send(self, key: Tuple[int, int], state: TypingState, typing: bool) -> None:
+        state.sent = typing
+        state.last_sent = time.monotonic()
+        await self.publish(key[0], key[1], typing)
+
+    def _forget(self, key: Tuple[int, int], state: TypingState) -> None:
+        if self._states.get(key) is state:
+            del self._states[key]
+
+    def _spawn(self, user_id: int, group_id: int, typing: bool) -> None:
+        task = asyncio.create_task(self.update(user_id, group_id, typing))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import uuid
+from typing import List, Optional, Tuple
+from fastapi import Request
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+from starlette.concurrency import run_in_threadpool
+from mysite.config import ATTACHMENT_DIR
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Upload:
+    def __init__(self, sha256: str, size: int, filename: str, content_type: str) -> None:
+        self.sha256 = sha256
+        self.size = size
+        self.filename = filename
+        self.content_type = content_type
+
+
+class AttachmentStore:
+    # files are named by their sha256, so identical uploads share one file
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    def temp_path(self) -> str:
+        # same filesystem as the final location, so publishing is an atomic rename
+        tmp = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp, exist_ok=True)
+        return os.path.join(tmp, uuid.uuid4().hex)
+
+    def publish(self, temp_path: str, sha256: str) -> str:
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return path
+
+
+attachment_store = AttachmentStore(ATTACHMENT_DIR)
+
+
+class _FilePart:
+    def __init__(self) -> None:
+        self.header_name = b''
+        self.header_value = b''
+        self.disposition = b''
+        self.content_type = b''
+        self.is_target = False
+
+
+async def receive_upload(request: Request, store: AttachmentStore, max_size: int,
+                         field: str = 'file') -> Upload:
+    # parses the multipart body as it arrives and writes the file part straight to disk
+    _, params = parse_options_header(request.headers.get('content-type', ''))
+    boundary = params.get(b'boundary')
+    if not boundary:
+        raise UploadError(400, 'multipart/form-data body expected')
+
+    part = _FilePart()
+    chunks: List[bytes] = []
+    found: Optional[Tuple[str, str]] = None
+
+    def on_part_begin() -> None:
+        nonlocal part
+        part = _FilePart()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        part.header_name += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        part.header_value += data[start:end]
+
+    def on_header_end() -> None:
+        name = part.header_name.lower()
+        if name == b'content-disposition':
+            part.disposition = part.header_value
+        elif name == b'content-type':
+            part.content_type = part.header_value
+        part.header_name = part.header_value = b''
+
+    def on_headers_finished() -> None:
+        nonlocal found
+        _, options = parse_options_header(part.disposition)
+        if found is None and options.get(b'name') == field.encode() and b'filename' in options:
+            part.is_target = True
+            found = (options[b'filename'].decode('utf-8', 'replace'),
+                     part.content_type.decode('latin-1') or 'application/octet-stream')
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if part.is_target:
+            chunks.append(data[start:end])
+
+    parser = MultipartParser(boundary, {
+        'on_part_begin': on_part_begin,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data,
+    })
+
+    digest = hashlib.sha256()
+    size = 0
+    temp_path = store.temp_path()
+    f = open(temp_path, 'wb')
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if not chunks:
+                continue
+            data = b''.join(chunks)
+            chunks.clear()
+            size += len(data)
+            if size > max_size:
+                raise UploadError(413, f'file is larger than {max_size} bytes')
+            digest.update(data)
+            await run_in_threadpool(f.write, data)
+        parser.finalize()
+        if found is None:
+            raise UploadError(400, f'form field "{field}" with a file is required')
+        await run_in_threadpool(_flush, f)
+    except BaseException as exc:
+        f.close()
+        os.remove(temp_path)
+        if isinstance(exc, MultipartParseError):
+            raise UploadError(400, 'malformed multipart body') from exc
+        raise
+    f.close()
+
+    sha256 = digest.hexdigest()
+    await run_in_threadpool(store.publish, temp_path, sha256)
+    return Upload(sha256, size, *found)
+
+
+def _flush(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
@@ -0,0 +1,191 @@
+import asyncio
+import inspect
+import logging
+import uuid
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+import orjson
+from mysite.config import BUS_URL, BUS_CHANNEL, BUS_PRESENCE_TTL
+
+logger = logging.getLogger('mysite.bus')
+
+WORKERS_KEY = 'bus:workers'
+
+
+class LocalBus:
+    # a single worker has nobody to tell: every event is already applied where it happened
+    def __init__(self) -> None:
+        self.worker_id = uuid.uuid4().hex
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+
+    def on(self, kind: str, handler: Callable[..., Any]) -> None:
+        # handlers apply an event to this worker only; they must not publish it again
+        self._handlers[kind] = handler
+
+    def publish(self, kind: str, **data) -> None:
+        pass
+
+    def set_online(self, user_id: int, online: bool) -> None:
+        pass
+
+    async def online(self, user_ids: Iterable[int]) -> Set[int]:
+        return set()
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def dispatch(self, raw: bytes) -> None:
+        event = orjson.loads(raw)
+        if event['origin'] == self.worker_id:
+            return
+        handler = self._handlers.get(event['kind'])
+        if handler is None:
+            return
+        try:
+            result = handler(**event['data'])
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception('bus event %s failed', event['kind'])
+
+
+class RedisBus(LocalBus):
+    # events go out on one pub/sub channel in publish order; presence is a set of user ids
+    # per worker that expires unless the worker keeps refreshing it
+    def __init__(self, url: str, channel: str = BUS_CHANNEL, presence_ttl: int = BUS_PRESENCE_TTL) -> None:
+        super().__init__()
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError('BUS_URL is set but the redis package is not installed')
+        self._client = redis.asyncio.Redis.from_url(url)
+        self.channel = channel
+        self.presence_ttl = presence_ttl
+        self.presence_key = f'bus:presence:{self.worker_id}'
+        self._online: Set[int] = set()
+        self._outbox: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+
+    def publish(self, kind: str, **data) -> None:
+        self._put(('publish', orjson.dumps({'origin': self.worker_id, 'kind': kind, 'data': data})))
+
+    def set_online(self, user_id: int, online: bool) -> None:
+        if online:
+            self._online.add(user_id)
+        else:
+            self._online.discard(user_id)
+        self._put(('sadd' if online else 'srem', user_id))
+
+    async def online(self, user_ids: Iterable[int]) -> Set[int]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        try:
+            workers = [w.decode() for w in await self._client.smembers(WORKERS_KEY)]
+            others = [w for w in workers if w != self.worker_id]
+            if not others:
+                return set()
+            pipe = self._client.pipeline(transaction=False)
+            for worker in others:
+                pipe.smismember(f'bus:presence:{worker}', user_ids)
+            found = await pipe.execute()
+        except Exception:
+            # unknown presence counts as offline: the user gets a digest instead of nothing
+            logger.exception('presence lookup failed')
+            return set()
+        return {uid for flags in found for uid, flag in zip(user_ids, flags) if flag}
+
+    async def start(self) -> None:
+        self._outbox = asyncio.Queue()
+        await self._refresh_presence()
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._send()),
+                       asyncio.create_task(self._keep_presence())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self._client.srem(WORKERS_KEY, self.worker_id)
+            await self._client.delete(self.presence_key)
+        except Exception:
+            logger.warning('could not remove presence of worker %s', self.worker_id)
+        await self._client.aclose()
+
+    def _put(self, item: tuple) -> None:
+        if self._outbox is not None:
+            self._outbox.put_nowait(item)
+
+    async def _send(self) -> None:
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty() and len(batch) < 500:
+                batch.append(self._outbox.get_nowait())
+            # one round trip for everything queued so far, still in order
+            pipe = self._client.pipeline(transaction=False)
+            for op, value in batch:
+                if op == 'publish':
+                    pipe.publish(self.channel, value)
+                elif op == 'sadd':
+                    pipe.sadd(self.presence_key, value)
+                    pipe.expire(self.presence_key, self.presence_ttl)
+                    pipe.sadd(WORKERS_KEY, self.worker_id)
+                else:
+                    pipe.srem(self.presence_key, value)
+            try:
+                await pipe.execute()
+            except Exception:
+                logger.exception('bus dropped %d operations', len(batch))
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        await self.dispatch(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('bus subscription lost, resubscribing')
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def _keep_presence(self) -> None:
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            try:
+                await self._refresh_presence()
+            except Exception:
+                logger.exception('presence refresh failed')
+
+    async def _refresh_presence(self) -> None:
+        # rewrites the whole set, so a restarted redis or a dropped srem heals itself
+        pipe = self._client.pipeline(transaction=True)
+        pipe.sadd(WORKERS_KEY, self.worker_id)
+        pipe.delete(self.presence_key)
+        if self._online:
+            pipe.sadd(self.presence_key, *self._online)
+            pipe.expire(self.presence_key, self.presence_ttl)
+        await pipe.execute()
+        await self._forget_dead_workers()
+
+    async def _forget_dead_workers(self) -> None:
+        for worker in await self._client.smembers(WORKERS_KEY):
+            worker = worker.decode()
+            if worker != self.worker_id and not await self._client.exists(f'bus:presence:{worker}'):
+                await self._client.srem(WORKERS_KEY, worker)
+
+
+def create_bus() -> LocalBus:
+    if BUS_URL:
+        return RedisBus(BUS_URL)
+    return LocalBus()
+
+
+bus = create_bus()
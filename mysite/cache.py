@@ -0,0 +1,304 @@
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+from fastapi import Request
+import orjson
+from fastapi.responses import ORJSONResponse
+from mysite.config import (RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_URL, WS_MEMBER_CACHE_TTL,
+                           RECENT_MESSAGES_PER_GROUP, RECENT_MESSAGES_MAX_GROUPS, RECENT_MESSAGES_TTL)
+from mysite.etag import etag_matches, not_modified, set_cache_headers
+from mysite.bus import bus
+
+logger = logging.getLogger('mysite.cache')
+
+
+class LRUBackend:
+    # per worker, so invalidations are repeated on the other workers over the bus
+    shared = False
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._items: OrderedDict = OrderedDict()
+
+    async def get(self, key: str) -> Optional[dict]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            self._items.pop(key, None)
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict, ttl: int) -> None:
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._items.pop(key, None)
+
+    async def delete_prefix(self, prefix: str) -> None:
+        for key in [k for k in self._items if k.startswith(prefix)]:
+            self._items.pop(key, None)
+
+
+class RedisBackend:
+    # the cache is an optimisation: when redis is unreachable reads miss and writes are skipped
+    shared = True
+
+    def __init__(self, url: str) -> None:
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_URL is set but the redis package is not installed')
+        self._client = redis.asyncio.Redis.from_url(url)
+        self._errors = redis.RedisError
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            raw = await self._client.get(key)
+        except self._errors as exc:
+            logger.warning('response cache get failed: %s', exc)
+            return None
+        return orjson.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: dict, ttl: int) -> None:
+        try:
+            await self._client.set(key, orjson.dumps(value), ex=ttl)
+        except self._errors as exc:
+            logger.warning('response cache set failed: %s', exc)
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self._client.delete(key)
+        except self._errors as exc:
+            # the entry lives on until its TTL
+            logger.error('response cache delete of %s failed: %s', key, exc)
+
+    async def delete_prefix(self, prefix: str) -> None:
+        try:
+            keys = [key async for key in self._client.scan_iter(match=f'{prefix}*')]
+            if keys:
+                await self._client.delete(*keys)
+        except self._errors as exc:
+            logger.error('response cache delete of %s* failed: %s', prefix, exc)
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl: int) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+    @staticmethod
+    def make_key(route: str, *params) -> str:
+        return ':'.join(['cache', route, *(str(p) for p in params)])
+
+    async def get(self, route: str, *params) -> Optional[dict]:
+        value = await self.backend.get(self.make_key(route, *params))
+        if value is None:
+            self.misses[route] += 1
+        else:
+            self.hits[route] += 1
+        return value
+
+    async def set(self, route: str, *params, content: Any, etag: str, store: bool = True) -> dict:
+        value = {'etag': etag, 'content': content}
+        if store:
+            await self.backend.set(self.make_key(route, *params), value, self.ttl)
+        return value
+
+    async def invalidate(self, route: str, *params) -> None:
+        key = self.make_key(route, *params)
+        await self.drop(key, prefix=not params)
+        if not self.backend.shared:
+            bus.publish('response_cache', key=key, prefix=not params)
+
+    async def drop(self, key: str, prefix: bool) -> None:
+        if prefix:
+            await self.backend.delete_prefix(key)
+        else:
+            await self.backend.delete(key)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {route: {'hits': self.hits[route], 'misses': self.misses[route]}
+                for route in set(self.hits) | set(self.misses)}
+
+
+class MembershipCache:
+    # group id -> member ids, local to the process; writes invalidate it through invalidate_members
+    def __init__(self, ttl: int) -> None:
+        self.ttl = ttl
+        self._items: Dict[int, Tuple[float, FrozenSet[int]]] = {}
+
+    def get(self, group_id: int) -> Optional[FrozenSet[int]]:
+        item = self._items.get(group_id)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+    def set(self, group_id: int, member_ids: Iterable[int]) -> FrozenSet[int]:
+        members = frozenset(member_ids)
+        self._items[group_id] = (time.monotonic() + self.ttl, members)
+        return members
+
+    def invalidate(self, group_id: Optional[int] = None) -> None:
+        if group_id is None:
+            self._items.clear()
+        else:
+            self._items.pop(group_id, None)
+
+
+class RecentBuffer:
+    __slots__ = ('items', 'complete', 'expires')
+
+    def __init__(self, items: Deque[dict], complete: bool, expires: float) -> None:
+        self.items = items
+        # True while the buffer holds every message of the group
+        self.complete = complete
+        self.expires = expires
+
+
+class RecentMessages:
+    # the newest messages of active groups, oldest first; bounded per group and in number of
+    # groups, cold groups are evicted first. Only touched from the event loop.
+    def __init__(self, size: int, max_groups: int, ttl: int) -> None:
+        self.size = size
+        self.max_groups = max_groups
+        self.ttl = ttl
+        self._groups: 'OrderedDict[int, RecentBuffer]' = OrderedDict()
+        self._loads: Dict[int, int] = {}
+        self._late: Dict[int, List[dict]] = {}
+        self._epochs: Dict[int, int] = {}
+
+    def latest(self, group_id: int, limit: int) -> Optional[List[dict]]:
+        buf = self._groups.get(group_id)
+        if buf is None:
+            return None
+        if buf.expires < time.monotonic():
+            del self._groups[group_id]
+            return None
+        if len(buf.items) < limit and not buf.complete:
+            return None
+        self._groups.move_to_end(group_id)
+        return list(islice(buf.items, max(len(buf.items) - limit, 0), None))
+
+    def buffered(self, group_id: int) -> bool:
+        buf = self._groups.get(group_id)
+        return buf is not None and buf.expires >= time.monotonic()
+
+    @contextmanager
+    def loading(self, group_id: int) -> Iterator[Callable[[List[dict], bool], None]]:
+        # messages appended while the page is read from the DB are merged into it, and an
+        # invalidation in the meantime discards the page
+        self._loads[group_id] = self._loads.get(group_id, 0) + 1
+        late = self._late.setdefault(group_id, [])
+        epoch = self._epochs.get(group_id, 0)
+
+        def store(items: List[dict], complete: bool) -> None:
+            if self._epochs.get(group_id, 0) != epoch or group_id in self._groups:
+                return
+            known = {m['id'] for m in items}
+            merged = sorted(items + [m for m in late if m['id'] not in known], key=lambda m: m['id'])
+            self._put(group_id, merged, complete and len(merged) <= self.size)
+
+        try:
+            yield store
+        finally:
+            self._loads[group_id] -= 1
+            if not self._loads[group_id]:
+                del self._loads[group_id]
+                self._late.pop(group_id, None)
+                self._epochs.pop(group_id, None)
+
+    def append(self, message: dict) -> None:
+        group_id = message['group_id']
+        if group_id in self._late:
+            self._late[group_id].append(message)
+        buf = self._groups.get(group_id)
+        if buf is None:
+            return
+        if buf.items and message['id'] <= buf.items[-1]['id']:
+            # concurrent sends finished out of order; reload rather than sort in place
+            self.invalidate(group_id)
+            return
+        if len(buf.items) == self.size:
+            buf.complete = False
+        buf.items.append(message)
+
+    def invalidate(self, group_id: Optional[int] = None) -> None:
+        if group_id is None:
+            self._groups.clear()
+            for gid in self._loads:
+                self._epochs[gid] = self._epochs.get(gid, 0) + 1
+            return
+        self._groups.pop(group_id, None)
+        if group_id in self._loads:
+            self._epochs[group_id] = self._epochs.get(group_id, 0) + 1
+
+    def _put(self, group_id: int, items: List[dict], complete: bool) -> None:
+        self._groups[group_id] = RecentBuffer(deque(items, maxlen=self.size), complete,
+                                              time.monotonic() + self.ttl)
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+
+
+def cached_response(request: Request, value: dict):
+    if etag_matches(request, value['etag']):
+        return not_modified(value['etag'])
+    response = ORJSONResponse(value['content'])
+    set_cache_headers(response, value['etag'])
+    return response
+
+
+def create_backend():
+    if RESPONSE_CACHE_URL:
+        return RedisBackend(RESPONSE_CACHE_URL)
+    return LRUBackend(RESPONSE_CACHE_MAX_ENTRIES)
+
+
+response_cache = ResponseCache(create_backend(), RESPONSE_CACHE_TTL)
+member_cache = MembershipCache(WS_MEMBER_CACHE_TTL)
+recent_messages = RecentMessages(RECENT_MESSAGES_PER_GROUP, RECENT_MESSAGES_MAX_GROUPS, RECENT_MESSAGES_TTL)
+
+
+async def invalidate_members(group_id: Optional[int] = None) -> None:
+    if group_id is None:
+        await response_cache.invalidate('people_by_group')
+    else:
+        await response_cache.invalidate('people_by_group', group_id)
+    member_cache.invalidate(group_id)
+    bus.publish('member_cache', group_id=group_id)
+
+
+def invalidate_recent(group_id: Optional[int] = None) -> None:
+    recent_messages.invalidate(group_id)
+    bus.publish('recent_invalidate', group_id=group_id)
+
+
+def append_recent(message: dict) -> None:
+    recent_messages.append(message)
+    bus.publish('recent_append', message=message)
+
+
+async def invalidate_user(user_id: int) -> None:
+    # deleting a user cascades to owned groups and memberships in any group
+    await response_cache.invalidate('user_detail', user_id)
+    await response_cache.invalidate('groups_by_owner', user_id)
+    await response_cache.invalidate('group_list')
+    await invalidate_members()
+    # their messages are gone from every group they wrote in
+    invalidate_recent()
+
+
+bus.on('response_cache', response_cache.drop)
+bus.on('member_cache', member_cache.invalidate)
+bus.on('recent_invalidate', recent_messages.invalidate)
+bus.on('recent_append', recent_messages.append)
@@ -8,3 +8,57 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_LIFETIME = 30
 REFRESH_TOKEN_LIFETIME = 3
+CACHE_CONTROL = os.getenv('CACHE_CONTROL', 'private, no-cache')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+RESPONSE_CACHE_URL = os.getenv('RESPONSE_CACHE_URL')
+MESSAGE_HISTORY_WINDOW_DAYS = int(os.getenv('MESSAGE_HISTORY_WINDOW_DAYS', 31))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+SQL_QUERY_WARN_THRESHOLD = int(os.getenv('SQL_QUERY_WARN_THRESHOLD', 10))
+SQL_REPEAT_WARN_THRESHOLD = int(os.getenv('SQL_REPEAT_WARN_THRESHOLD', 3))
+WS_MAX_INFLIGHT = int(os.getenv('WS_MAX_INFLIGHT', 8))
+WS_CLOSE_GRACE_SECONDS = float(os.getenv('WS_CLOSE_GRACE_SECONDS', 10))
+WS_BATCH_DELAY_MS = int(os.getenv('WS_BATCH_DELAY_MS', 5))
+WS_BATCH_MAX_EVENTS = int(os.getenv('WS_BATCH_MAX_EVENTS', 50))
+WS_SYNC_MAX_MESSAGES = int(os.getenv('WS_SYNC_MAX_MESSAGES', 500))
+DB_REPLICA_URLS = [url.strip() for url in os.getenv('DB_REPLICA_URLS', '').split(',') if url.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 5))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 10))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_KEY_RETENTION_HOURS = int(os.getenv('IDEMPOTENCY_KEY_RETENTION_HOURS', 48))
+GROUP_ASYNC_DELETE_THRESHOLD = int(os.getenv('GROUP_ASYNC_DELETE_THRESHOLD', 10000))
+GROUP_PURGE_BATCH_SIZE = int(os.getenv('GROUP_PURGE_BATCH_SIZE', 5000))
+WS_MEMBER_CACHE_TTL = int(os.getenv('WS_MEMBER_CACHE_TTL', 30))
+WS_TYPING_THROTTLE_MS = int(os.getenv('WS_TYPING_THROTTLE_MS', 2000))
+WS_TYPING_TTL_MS = int(os.getenv('WS_TYPING_TTL_MS', 6000))
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', 'attachments')
+ATTACHMENT_MAX_SIZE = int(os.getenv('ATTACHMENT_MAX_SIZE', 50 * 1024 * 1024))
+OFFLINE_NOTIFY_DELAY = float(os.getenv('OFFLINE_NOTIFY_DELAY', 60))
+OFFLINE_QUEUE_MAX_USERS = int(os.getenv('OFFLINE_QUEUE_MAX_USERS', 100000))
+OFFLINE_NOTIFIER = os.getenv('OFFLINE_NOTIFIER', 'mysite.api.ws_offline:LogNotifier')
+WS_DRAIN_SECONDS = float(os.getenv('WS_DRAIN_SECONDS', 30))
+WS_ADMIT_PER_SECOND = float(os.getenv('WS_ADMIT_PER_SECOND', 200))
+WS_ADMIT_BURST = int(os.getenv('WS_ADMIT_BURST', 400))
+WS_RECONNECT_JITTER_MS = int(os.getenv('WS_RECONNECT_JITTER_MS', 5000))
+WS_HEARTBEAT_INTERVAL = float(os.getenv('WS_HEARTBEAT_INTERVAL', 25))
+WS_HEARTBEAT_TIMEOUT = float(os.getenv('WS_HEARTBEAT_TIMEOUT', 60))
+RECENT_MESSAGES_PER_GROUP = int(os.getenv('RECENT_MESSAGES_PER_GROUP', 100))
+RECENT_MESSAGES_MAX_GROUPS = int(os.getenv('RECENT_MESSAGES_MAX_GROUPS', 5000))
+RECENT_MESSAGES_TTL = int(os.getenv('RECENT_MESSAGES_TTL', 300))
+SERVER_APP = os.getenv('SERVER_APP', 'main:chat_app')
+SERVER_HOST = os.getenv('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('SERVER_PORT', 8998))
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', 1))
+SERVER_LOOP = os.getenv('SERVER_LOOP', 'auto')
+SERVER_HTTP = os.getenv('SERVER_HTTP', 'auto')
+SERVER_BACKLOG = int(os.getenv('SERVER_BACKLOG', 2048))
+SERVER_KEEPALIVE = int(os.getenv('SERVER_KEEPALIVE', 5))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30))
+WS_PING_INTERVAL = float(os.getenv('WS_PING_INTERVAL', 20))
+WS_PING_TIMEOUT = float(os.getenv('WS_PING_TIMEOUT', 20))
+DB_POOL_PREWARM = int(os.getenv('DB_POOL_PREWARM', 5))
+BUS_URL = os.getenv('BUS_URL')
+BUS_CHANNEL = os.getenv('BUS_CHANNEL', 'bus:events')
+BUS_PRESENCE_TTL = int(os.getenv('BUS_PRESENCE_TTL', 30))
@@ -0,0 +1,208 @@
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from mysite.config import ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, IDEMPOTENCY_KEY_RETENTION_HOURS
+from .db import SessionLocal
+from .models import ChatMessage
+from .idempotency import prune_keys
+
+MAGIC = b'MSEG'
+FOOTER = struct.Struct('<Q4s')
+BLOCK_SIZE = 256
+SEGMENT_MAX_MESSAGES = 10000
+
+Segment = Tuple[int, int, str]
+
+
+def message_record(m: ChatMessage) -> dict:
+    return {
+        'id': m.id,
+        'group_id': m.group_id,
+        'user_id': m.user_id,
+        'text': m.text,
+        'attachment_id': m.attachment_id,
+        'created_date': m.created_date.isoformat() if m.created_date else None,
+    }
+
+
+def write_segment(path: str, records: List[dict]) -> None:
+    index = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for start in range(0, len(records), BLOCK_SIZE):
+            block = records[start:start + BLOCK_SIZE]
+            data = zlib.compress(json.dumps(block, separators=(',', ':')).encode())
+            index.append([block[0]['id'], block[-1]['id'], f.tell(), len(data)])
+            f.write(data)
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode())
+        f.write(FOOTER.pack(index_offset, MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SegmentReader:
+    def __init__(self, path: str) -> None:
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, magic = FOOTER.unpack(self._map[-FOOTER.size:])
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a message segment')
+        self.blocks = json.loads(self._map[index_offset:len(self._map) - FOOTER.size])
+
+    def read_block(self, offset: int, length: int) -> List[dict]:
+        return json.loads(zlib.decompress(self._map[offset:offset + length]))
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class MessageArchive:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._segments: Dict[int, Tuple[float, List[Segment]]] = {}
+
+    def group_dir(self, group_id: int) -> str:
+        return os.path.join(self.root, str(group_id))
+
+    def segments(self, group_id: int) -> List[Segment]:
+        path = self.group_dir(group_id)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return []
+
+        cached = self._segments.get(group_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        found = []
+        for name in os.listdir(path):
+            if not name.endswith('.seg'):
+                continue
+            first_id, last_id = name[:-4].split('-')
+            found.append((int(first_id), int(last_id), os.path.join(path, name)))
+        found.sort()
+        self._segments[group_id] = (mtime, found)
+        return found
+
+    def boundary(self, group_id: int) -> int:
+        segments = self.segments(group_id)
+        return segments[-1][1] if segments else 0
+
+    def append(self, group_id: int, records: List[dict]) -> None:
+        os.makedirs(self.group_dir(group_id), exist_ok=True)
+        name = f"{records[0]['id']:012d}-{records[-1]['id']:012d}.seg"
+        write_segment(os.path.join(self.group_dir(group_id), name), records)
+
+    def read_before(self, group_id: int, before_id: Optional[int], limit: int) -> List[dict]:
+        result: List[dict] = []
+        for first_id, _, path in reversed(self.segments(group_id)):
+            if before_id is not None and first_id >= before_id:
+                continue
+            with SegmentReader(path) as reader:
+                for block_first, _, offset, length in reversed(reader.blocks):
+                    if before_id is not None and block_first >= before_id:
+                        continue
+                    block = [r for r in reader.read_block(offset, length)
+                             if before_id is None or r['id'] < before_id]
+                    result[:0] = block[-(limit - len(result)):]
+                    if len(result) >= limit:
+                        return result
+        return result
+
+    def drop_group(self, group_id: int) -> None:
+        shutil.rmtree(self.group_dir(group_id), ignore_errors=True)
+        self._segments.pop(group_id, None)
+
+    def read_last(self, group_id: int) -> List[dict]:
+        segments = self.segments(group_id)
+        if not segments:
+            return []
+        result: List[dict] = []
+        with SegmentReader(segments[-1][2]) as reader:
+            for _, _, offset, length in reader.blocks:
+                result.extend(reader.read_block(offset, length))
+        return result
+
+
+message_archive = MessageArchive(ARCHIVE_DIR)
+
+
+def archive_group(db: Session, group_id: int, cutoff: datetime) -> int:
+    # rows of the last segment that an interrupted run wrote but did not delete
+    written = [r['id'] for r in message_archive.read_last(group_id)]
+    if written:
+        delete_ids(db, written)
+
+    # only a prefix of the group's ids is archived, so every id up to the boundary lives in
+    # the archive; a row dated after the cutoff stops the run until it is old enough too
+    boundary = message_archive.boundary(group_id)
+    stop = db.query(func.min(ChatMessage.id)).filter(ChatMessage.group_id == group_id,
+                                                     ChatMessage.id > boundary,
+                                                     ChatMessage.created_date >= cutoff).scalar()
+    archived = 0
+    while True:
+        q = db.query(ChatMessage).filter(ChatMessage.group_id == group_id,
+                                         ChatMessage.id > boundary,
+                                         ChatMessage.created_date < cutoff)
+        if stop is not None:
+            q = q.filter(ChatMessage.id < stop)
+        rows = q.order_by(ChatMessage.id).limit(SEGMENT_MAX_MESSAGES).all()
+        if not rows:
+            return archived
+
+        message_archive.append(group_id, [message_record(m) for m in rows])
+        boundary = rows[-1].id
+        delete_ids(db, [m.id for m in rows])
+        archived += len(rows)
+
+
+def delete_ids(db: Session, ids: List[int]) -> None:
+    db.query(ChatMessage).filter(ChatMessage.id.in_(ids)).delete(synchronize_session=False)
+    db.commit()
+
+
+def archive_messages(db: Session, older_than_days: int) -> Dict[int, int]:
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    group_ids = [r[0] for r in db.query(ChatMessage.group_id)
+                 .filter(ChatMessage.created_date < cutoff).distinct().all()]
+    return {group_id: archive_group(db, group_id, cutoff) for group_id in group_ids}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Move old messages into compressed archive segments')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='archive messages older than this many days')
+    parser.add_argument('--key-retention-hours', type=int, default=IDEMPOTENCY_KEY_RETENTION_HOURS,
+                        help='delete message idempotency keys older than this many hours')
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        for group_id, count in archive_messages(db, args.days).items():
+            print(f'group {group_id}: archived {count} messages')
+        print(f'pruned {prune_keys(db, args.key_retention_hours)} idempotency keys')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+from typing import Dict, List, Sequence
+from sqlalchemy import and_, func, select, true
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+from .models import ChatMessage, GroupPeople
+
+MESSAGE_COLUMNS = (ChatMessage.id, ChatMessage.group_id, ChatMessage.user_id, ChatMessage.text,
+                   ChatMessage.attachment_id, ChatMessage.created_date)
+
+
+def latest_messages(db: Session, user_id: int, group_ids: Sequence[int], limit: int) -> Dict[int, List[Row]]:
+    # empty group_ids means all of the user's groups; groups they are not in are left out
+    groups = select(GroupPeople.group_id).where(GroupPeople.user_id == user_id)
+    if group_ids:
+        groups = groups.where(GroupPeople.group_id.in_(group_ids))
+    groups = groups.subquery('g')
+
+    if db.get_bind().dialect.name == 'postgresql':
+        # one index range scan on message(group_id, id) per group
+        page = (
+            select(*MESSAGE_COLUMNS)
+            .where(ChatMessage.group_id == groups.c.group_id)
+            .order_by(ChatMessage.id.desc())
+            .limit(limit)
+            .lateral('page')
+        )
+        on = true()
+    else:
+        page = (
+            select(*MESSAGE_COLUMNS, func.row_number().over(
+                partition_by=ChatMessage.group_id, order_by=ChatMessage.id.desc()).label('rn'))
+            .where(ChatMessage.group_id.in_(select(groups.c.group_id)))
+            .subquery('page')
+        )
+        on = and_(page.c.group_id == groups.c.group_id, page.c.rn <= limit)
+
+    stmt = (
+        select(groups.c.group_id.label('gid'), page.c.id, page.c.group_id, page.c.user_id, page.c.text,
+               page.c.attachment_id, page.c.created_date)
+        .select_from(groups.outerjoin(page, on))
+        .order_by(groups.c.group_id, page.c.id)
+    )
+    result: Dict[int, List[Row]] = {}
+    for row in db.execute(stmt):
+        items = result.setdefault(row.gid, [])
+        if row.id is not None:
+            items.append(row)
+    return result
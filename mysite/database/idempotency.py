@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from mysite.config import IDEMPOTENCY_CACHE_SIZE
+from .models import ChatMessage, MessageIdempotencyKey
+
+
+class RecentKeys:
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, key: str) -> Optional[int]:
+        with self._lock:
+            message_id = self._items.get((user_id, key))
+            if message_id is not None:
+                self._items.move_to_end((user_id, key))
+            return message_id
+
+    def put(self, user_id: int, key: str, message_id: int) -> None:
+        with self._lock:
+            self._items[(user_id, key)] = message_id
+            self._items.move_to_end((user_id, key))
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def discard(self, user_id: int, key: str) -> None:
+        with self._lock:
+            self._items.pop((user_id, key), None)
+
+
+recent_keys = RecentKeys(IDEMPOTENCY_CACHE_SIZE)
+
+
+class IdempotencyConflict(Exception):
+    # the key was already used for a message with different content
+    pass
+
+
+def check_same(message: ChatMessage, group_id: int, text: str, attachment_id: Optional[int]) -> ChatMessage:
+    if (message.group_id, message.text, message.attachment_id) != (group_id, text, attachment_id):
+        raise IdempotencyConflict(message.id)
+    return message
+
+
+def find_message(db: Session, user_id: int, key: str) -> Optional[ChatMessage]:
+    message_id = recent_keys.get(user_id, key)
+    if message_id is None:
+        message_id = db.query(MessageIdempotencyKey.message_id).filter(
+            MessageIdempotencyKey.user_id == user_id,
+            MessageIdempotencyKey.key == key
+        ).scalar()
+        if message_id is None:
+            return None
+
+    message = db.query(ChatMessage).filter(ChatMessage.id == message_id).first()
+    if message is None:
+        # the original was deleted since, so the key no longer protects anything
+        recent_keys.discard(user_id, key)
+        db.query(MessageIdempotencyKey).filter(
+            MessageIdempotencyKey.user_id == user_id,
+            MessageIdempotencyKey.key == key
+        ).delete()
+        return None
+    recent_keys.put(user_id, key, message.id)
+    return message
+
+
+def create_message(db: Session, group_id: int, user_id: int, text: str, key: Optional[str] = None,
+                   attachment_id: Optional[int] = None) -> Tuple[ChatMessage, bool]:
+    # returns (message, created); a repeated key returns the original message instead of inserting
+    if key:
+        existing = find_message(db, user_id, key)
+        if existing is not None:
+            return check_same(existing, group_id, text, attachment_id), False
+
+    message = ChatMessage(group_id=group_id, user_id=user_id, text=text, attachment_id=attachment_id)
+    db.add(message)
+    if key:
+        db.flush()
+        db.add(MessageIdempotencyKey(user_id=user_id, key=key, message_id=message.id))
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # a concurrent retry inserted the same key first
+        existing = find_message(db, user_id, key) if key else None
+        if existing is None:
+            raise
+        return check_same(existing, group_id, text, attachment_id), False
+
+    db.refresh(message)
+    if key:
+        recent_keys.put(user_id, key, message.id)
+    return message, True
+
+
+def prune_keys(db: Session, retention_hours: int) -> int:
+    # a retry arrives within seconds or minutes; older keys only take up space
+    cutoff = datetime.utcnow() - timedelta(hours=retention_hours)
+    deleted = db.query(MessageIdempotencyKey).filter(
+        MessageIdempotencyKey.created_date < cutoff
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
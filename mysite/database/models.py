@@ -1,9 +1,9 @@
 from .db import Base
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Enum, Date, ForeignKey, DateTime, Text
+from sqlalchemy.orm import Mapped, mapped_column, relationship, object_session
+from sqlalchemy import event, Integer, BigInteger, String, Enum, Date, ForeignKey, DateTime, Text, Index
 from enum import Enum as PyEnum
 from datetime import date, datetime
-from typing import List
+from typing import List, Optional
 
 class StatusChoices(str, PyEnum):
     admin = 'admin'
@@ -18,25 +18,28 @@ class UserProfile(Base):
     password: Mapped[str] = mapped_column(String)
     user_status: Mapped[StatusChoices] = mapped_column(Enum(StatusChoices), default=StatusChoices.simple)
     date_register: Mapped[date] = mapped_column(Date, default=date.today)
+    updated_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version: Mapped[int] = mapped_column(Integer, default=1)
 
-    owner_chat: Mapped[List['ChatGroup']] = relationship(back_populates='owner',
-                                                        cascade='all, delete-orphan')
-    user_groups: Mapped[List['GroupPeople']] = relationship(back_populates='user',
-                                                            cascade='all, delete-orphan')
+    # no relationship loads lazily; a query that needs one asks for it with selectinload/joinedload
+    owner_chat: Mapped[List['ChatGroup']] = relationship(back_populates='owner', lazy='raise',
+                                                        cascade='all, delete-orphan', passive_deletes=True)
+    user_groups: Mapped[List['GroupPeople']] = relationship(back_populates='user', lazy='raise',
+                                                            cascade='all, delete-orphan', passive_deletes=True)
 
-    user_sms: Mapped[List['ChatMessage']] = relationship(back_populates='user_message',
-                                                         cascade='all, delete-orphan')
+    user_sms: Mapped[List['ChatMessage']] = relationship(back_populates='user_message', lazy='raise',
+                                                         cascade='all, delete-orphan', passive_deletes=True)
 
-    user_token: Mapped[List['RefreshToken']] = relationship(back_populates='user',
-                                                            cascade='all, delete-orphan')
+    user_token: Mapped[List['RefreshToken']] = relationship(back_populates='user', lazy='raise',
+                                                            cascade='all, delete-orphan', passive_deletes=True)
 
 
 class RefreshToken(Base):
     __tablename__ = 'refresh_token'
 
     id: Mapped[int] = mapped_column(Integer, autoincrement=True, primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id'))
-    user: Mapped[UserProfile] = relationship(back_populates='user_token')
+    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id', ondelete='CASCADE'), index=True)
+    user: Mapped[UserProfile] = relationship(back_populates='user_token', lazy='raise')
     token: Mapped[str] = mapped_column(String, nullable=False)
     created_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
@@ -46,35 +49,80 @@ class ChatGroup(Base):
     __tablename__ = 'group'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey('profile.id'))
-    owner: Mapped[UserProfile] = relationship(UserProfile, back_populates='owner_chat')
+    owner_id: Mapped[int] = mapped_column(ForeignKey('profile.id', ondelete='CASCADE'), index=True)
+    owner: Mapped[UserProfile] = relationship(UserProfile, back_populates='owner_chat', lazy='raise')
     name: Mapped[str] = mapped_column(String(100))
     create_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version: Mapped[int] = mapped_column(Integer, default=1)
+    # set when a large group is being purged in the background
+    deleted_date: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
-    group_chats: Mapped[List['GroupPeople']] = relationship(back_populates='group',
-                                                            cascade='all, delete-orphan')
+    group_chats: Mapped[List['GroupPeople']] = relationship(back_populates='group', lazy='raise',
+                                                            cascade='all, delete-orphan', passive_deletes=True)
 
-    group_messages: Mapped[List['ChatMessage']] = relationship(back_populates='group_mes',
-                                                               cascade='all, delete-orphan')
+    group_messages: Mapped[List['ChatMessage']] = relationship(back_populates='group_mes', lazy='raise',
+                                                               cascade='all, delete-orphan', passive_deletes=True)
 
 class GroupPeople(Base):
     __tablename__ = 'people'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    group_id: Mapped[int] = mapped_column(ForeignKey('group.id'))
-    group: Mapped[ChatGroup] = relationship(ChatGroup, back_populates='group_chats')
-    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id'))
-    user: Mapped[UserProfile] = relationship(back_populates='user_groups')
+    group_id: Mapped[int] = mapped_column(ForeignKey('group.id', ondelete='CASCADE'), index=True)
+    group: Mapped[ChatGroup] = relationship(ChatGroup, back_populates='group_chats', lazy='raise')
+    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id', ondelete='CASCADE'), index=True)
+    user: Mapped[UserProfile] = relationship(back_populates='user_groups', lazy='raise')
     joined_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version: Mapped[int] = mapped_column(Integer, default=1)
 
 
 class ChatMessage(Base):
     __tablename__ = 'message'
+    __table_args__ = (Index('ix_message_group_id_id', 'group_id', 'id'),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    group_id: Mapped[int] = mapped_column(ForeignKey('group.id'))
-    group_mes: Mapped[ChatGroup] = relationship(ChatGroup, back_populates='group_messages')
-    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id'))
-    user_message: Mapped[UserProfile] = relationship(back_populates='user_sms')
+    group_id: Mapped[int] = mapped_column(ForeignKey('group.id', ondelete='CASCADE'))
+    group_mes: Mapped[ChatGroup] = relationship(ChatGroup, back_populates='group_messages', lazy='raise')
+    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id', ondelete='CASCADE'), index=True)
+    user_message: Mapped[UserProfile] = relationship(back_populates='user_sms', lazy='raise')
     text: Mapped[str] = mapped_column(Text)
+    attachment_id: Mapped[Optional[int]] = mapped_column(ForeignKey('attachment.id', ondelete='SET NULL'),
+                                                         nullable=True, index=True)
+    attachment: Mapped[Optional['Attachment']] = relationship(lazy='raise')
     created_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version: Mapped[int] = mapped_column(Integer, default=1)
+
+
+class Attachment(Base):
+    __tablename__ = 'attachment'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # one row per upload; rows with the same content share one file on disk
+    sha256: Mapped[str] = mapped_column(String(64), index=True)
+    size: Mapped[int] = mapped_column(BigInteger)
+    content_type: Mapped[str] = mapped_column(String(255))
+    filename: Mapped[str] = mapped_column(String(255))
+    uploader_id: Mapped[Optional[int]] = mapped_column(ForeignKey('profile.id', ondelete='SET NULL'), nullable=True)
+    created_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class MessageIdempotencyKey(Base):
+    __tablename__ = 'message_idempotency'
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('profile.id', ondelete='CASCADE'), primary_key=True)
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    message_id: Mapped[int] = mapped_column(Integer)
+    created_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+def _bump_version(mapper, connection, target) -> None:
+    # version only feeds ETags; it is incremented in the UPDATE itself, so concurrent
+    # writers both bump it and neither is rejected
+    if object_session(target).is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
+
+
+for _model in (UserProfile, ChatGroup, GroupPeople, ChatMessage):
+    event.listen(_model, 'before_update', _bump_version)
@@ -0,0 +1,136 @@
+import argparse
+from datetime import date
+from typing import List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from .db import engine
+
+PARENT_TABLE = 'message'
+# catches inserts for months nobody created a partition for yet
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'{PARENT_TABLE}_p{month.year}_{month.month:02d}'
+
+
+def partition_month(name: str) -> Optional[date]:
+    prefix = f'{PARENT_TABLE}_p'
+    if not name.startswith(prefix):
+        return None
+    try:
+        year, month = name[len(prefix):].split('_')
+        return date(int(year), int(month), 1)
+    except ValueError:
+        return None
+
+
+def create_partition(conn: Connection, month: date) -> None:
+    name = partition_name(month)
+    bounds = f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    if conn.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None:
+        return
+    if not has_default_rows(conn, month):
+        conn.execute(text(f'CREATE TABLE "{name}" PARTITION OF "{PARENT_TABLE}" {bounds}'))
+        return
+    # rows that landed in the default partition while this month was missing are moved
+    # out first, otherwise postgres refuses to carve the range out of the default
+    conn.execute(text(f'CREATE TABLE "{name}" (LIKE "{PARENT_TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    conn.execute(text(
+        f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" '
+        f'WHERE created_date >= :start AND created_date < :end RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved'
+    ), {'start': month, 'end': add_months(month, 1)})
+    conn.execute(text(f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{name}" {bounds}'))
+
+
+def create_default_partition(conn: Connection) -> None:
+    conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}" PARTITION OF "{PARENT_TABLE}" DEFAULT'))
+
+
+def has_default_rows(conn: Connection, month: Optional[date] = None) -> bool:
+    if conn.execute(text('SELECT to_regclass(:name)'), {'name': DEFAULT_PARTITION}).scalar() is None:
+        return False
+    where = ''
+    params = {}
+    if month is not None:
+        where = ' WHERE created_date >= :start AND created_date < :end'
+        params = {'start': month, 'end': add_months(month, 1)}
+    return conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}"{where})'), params).scalar()
+
+
+def default_months(conn: Connection) -> List[date]:
+    if not has_default_rows(conn):
+        return []
+    rows = conn.execute(text(
+        f'SELECT DISTINCT date_trunc(\'month\', created_date)::date FROM "{DEFAULT_PARTITION}" ORDER BY 1'
+    ))
+    return [r[0] for r in rows]
+
+
+def list_partitions(conn: Connection) -> List[str]:
+    rows = conn.execute(text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = :parent ORDER BY c.relname'
+    ), {'parent': PARENT_TABLE})
+    return [r[0] for r in rows]
+
+
+def ensure_partitions(conn: Connection, months_ahead: int, start: Optional[date] = None) -> List[str]:
+    first = month_start(start or date.today())
+    last = add_months(month_start(date.today()), months_ahead)
+    months = set(default_months(conn))
+    month = first
+    while month <= last:
+        months.add(month)
+        month = add_months(month, 1)
+    created = []
+    for month in sorted(months):
+        create_partition(conn, month)
+        created.append(partition_name(month))
+    return created
+
+
+def detach_partitions(conn: Connection, retain_months: int, drop: bool = False) -> List[str]:
+    cutoff = add_months(month_start(date.today()), -retain_months)
+    detached = []
+    for name in list_partitions(conn):
+        month = partition_month(name)
+        if month is None or month >= cutoff:
+            continue
+        conn.execute(text(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"'))
+        if drop:
+            conn.execute(text(f'DROP TABLE "{name}"'))
+        detached.append(name)
+    return detached
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Maintain monthly partitions of the message table')
+    parser.add_argument('--ahead', type=int, default=3, help='months of future partitions to pre-create')
+    parser.add_argument('--detach-older-than', type=int, default=None,
+                        help='detach partitions older than this many months')
+    parser.add_argument('--drop', action='store_true', help='drop detached partitions')
+    args = parser.parse_args(argv)
+
+    with engine.begin() as conn:
+        for name in ensure_partitions(conn, args.ahead):
+            print(f'ensured {name}')
+        if args.detach_older_than is not None:
+            for name in detach_partitions(conn, args.detach_older_than, drop=args.drop):
+                print(f'{"dropped" if args.drop else "detached"} {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import logging
+from datetime import datetime
+from typing import Callable, Dict
+from sqlalchemy.orm import Session
+from mysite.config import GROUP_ASYNC_DELETE_THRESHOLD, GROUP_PURGE_BATCH_SIZE
+from .archive import message_archive
+from .db import SessionLocal
+from .models import ChatGroup, ChatMessage, GroupPeople
+
+logger = logging.getLogger('mysite.purge')
+
+
+def has_more_messages(db: Session, group_id: int, threshold: int) -> bool:
+    return db.query(ChatMessage.id).filter(ChatMessage.group_id == group_id).offset(threshold).limit(1).first() is not None
+
+
+def tombstone_group(db: Session, group: ChatGroup) -> None:
+    # the group disappears for everyone at once: no members, hidden from listings
+    group.deleted_date = datetime.utcnow()
+    db.query(GroupPeople).filter(GroupPeople.group_id == group.id).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_group(group_id: int, batch_size: int = GROUP_PURGE_BATCH_SIZE) -> int:
+    db = SessionLocal()
+    total = 0
+    try:
+        while True:
+            # short transactions bounded by id ranges on message(group_id, id) keep locks brief
+            upper = db.query(ChatMessage.id).filter(ChatMessage.group_id == group_id).order_by(
+                ChatMessage.id).offset(batch_size - 1).limit(1).scalar()
+            q = db.query(ChatMessage).filter(ChatMessage.group_id == group_id)
+            if upper is not None:
+                q = q.filter(ChatMessage.id <= upper)
+            total += q.delete(synchronize_session=False)
+            db.commit()
+            if upper is None:
+                break
+
+        db.query(ChatGroup).filter(ChatGroup.id == group_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    message_archive.drop_group(group_id)
+    logger.info('purged group %s: %s messages', group_id, total)
+    return total
+
+
+def delete_group(db: Session, group: ChatGroup, schedule: Callable[..., None]) -> bool:
+    # returns True when the group was tombstoned and its purge handed to `schedule`
+    if has_more_messages(db, group.id, GROUP_ASYNC_DELETE_THRESHOLD):
+        tombstone_group(db, group)
+        schedule(purge_group, group.id)
+        return True
+
+    group_id = group.id
+    db.delete(group)
+    db.commit()
+    message_archive.drop_group(group_id)
+    return False
+
+
+def purge_deleted_groups(batch_size: int = GROUP_PURGE_BATCH_SIZE) -> Dict[int, int]:
+    db = SessionLocal()
+    try:
+        group_ids = [r[0] for r in db.query(ChatGroup.id).filter(ChatGroup.deleted_date.isnot(None)).all()]
+    finally:
+        db.close()
+    return {group_id: purge_group(group_id, batch_size) for group_id in group_ids}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Finish purging tombstoned groups')
+    parser.add_argument('--batch-size', type=int, default=GROUP_PURGE_BATCH_SIZE,
+                        help='messages deleted per transaction')
+    args = parser.parse_args(argv)
+
+    for group_id, count in purge_deleted_groups(args.batch_size).items():
+        print(f'group {group_id}: purged {count} messages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+from mysite.config import (DB_REPLICA_URLS, DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL,
+                           READ_YOUR_WRITES_SECONDS)
+
+logger = logging.getLogger('mysite.sql')
+
+# zero while the replica has replayed everything it received, so an idle primary does not look like lag
+LAG_QUERY = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+)
+
+
+class ReplicaSet:
+    def __init__(self, engines: List[Engine], max_lag: float = DB_REPLICA_MAX_LAG,
+                 check_interval: float = DB_REPLICA_CHECK_INTERVAL) -> None:
+        self.engines = engines
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag: Dict[Engine, Tuple[float, Optional[float]]] = {}
+        self._next = itertools.cycle(engines) if engines else None
+        self._lock = threading.Lock()
+
+    def lag(self, engine: Engine) -> Optional[float]:
+        checked, lag = self._lag.get(engine, (0.0, None))
+        now = time.monotonic()
+        if now - checked < self.check_interval:
+            return lag
+        try:
+            with engine.connect() as conn:
+                lag = float(conn.execute(LAG_QUERY).scalar() or 0) if engine.dialect.name == 'postgresql' else 0.0
+        except Exception:
+            logger.warning('replica %s is unreachable', engine.url.render_as_string(hide_password=True))
+            lag = None
+        self._lag[engine] = (now, lag)
+        return lag
+
+    def pick(self) -> Optional[Engine]:
+        if self._next is None:
+            return None
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = next(self._next)
+            lag = self.lag(engine)
+            if lag is not None and lag <= self.max_lag:
+                return engine
+        return None
+
+
+class StickyWriters:
+    # clients that wrote recently read from the primary until their write has surely replicated
+    def __init__(self, seconds: float = READ_YOUR_WRITES_SECONDS) -> None:
+        self.seconds = seconds
+        self._until: Dict[Hashable, float] = {}
+
+    def mark(self, key: Hashable) -> None:
+        now = time.monotonic()
+        if len(self._until) > 10000:
+            self._until = {k: t for k, t in self._until.items() if t > now}
+        self._until[key] = now + self.seconds
+
+    def is_sticky(self, key: Optional[Hashable]) -> bool:
+        return key is not None and self._until.get(key, 0) > time.monotonic()
+
+
+replicas = ReplicaSet([create_engine(url, pool_pre_ping=True) for url in DB_REPLICA_URLS])
+sticky_writers = StickyWriters()
+
+
+class RoutingSession(Session):
+    # sessions opened with info={'read_only': True} send their SELECTs to a healthy replica
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (self.info.get('read_only') and not self._flushing and not isinstance(clause, UpdateBase)
+                and not sticky_writers.is_sticky(self.info.get('sticky_key'))):
+            replica = self.info.get('replica') or replicas.pick()
+            if replica is not None:
+                # keep one replica per session so a page of reads sees one snapshot
+                self.info['replica'] = replica
+                return replica
+        return super().get_bind(mapper, clause=clause, **kw)
@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
-from datetime import date, datetime
+from pydantic import BaseModel, EmailStr, Field, StringConstraints, field_validator, model_validator
+from typing import Optional, List, Dict, Annotated
+from datetime import date, datetime, timezone
 from enum import Enum
 
 
@@ -77,7 +77,9 @@ class GroupPeopleOutSchema(BaseModel):
 class ChatMessageCreateSchema(BaseModel):
     group_id: int
     user_id: int
-    text: str
+    text: str = ''
+    attachment_id: Optional[int] = None
+    idempotency_key: Optional[str] = Field(None, min_length=1, max_length=64)
 
     class Config:
         from_attributes = True
@@ -88,7 +90,80 @@ class ChatMessageOutSchema(BaseModel):
     group_id: int
     user_id: int
     text: str
+    attachment_id: Optional[int] = None
     created_date: datetime
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class CreateGroupActionSchema(BaseModel):
+    name: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+
+class ListGroupsActionSchema(BaseModel):
+    pass
+
+
+class RenameGroupActionSchema(BaseModel):
+    group_id: int
+    name: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+
+class AddMembersActionSchema(BaseModel):
+    group_id: int
+    user_ids: List[int] = Field(min_length=1)
+
+
+class SendMessageActionSchema(BaseModel):
+    group_id: int
+    text: Annotated[str, StringConstraints(strip_whitespace=True)] = ''
+    attachment_id: Optional[int] = None
+    idempotency_key: Optional[str] = Field(None, min_length=1, max_length=64)
+
+    @model_validator(mode='after')
+    def text_or_attachment(self):
+        if not self.text and self.attachment_id is None:
+            raise ValueError('text or attachment_id is required')
+        return self
+
+
+class FetchMessagesActionSchema(BaseModel):
+    group_id: int
+    limit: int = Field(50, ge=1)
+    before_id: Optional[int] = None
+
+
+class TypingActionSchema(BaseModel):
+    group_id: int
+    typing: bool = True
+
+
+class SyncActionSchema(BaseModel):
+    since_id: int = Field(0, ge=0)
+    cursors: Dict[int, int] = Field(default_factory=dict)
+    groups_since: Optional[datetime] = None
+    limit: int = Field(200, ge=1)
+
+    @field_validator('groups_since')
+    @classmethod
+    def naive_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        # stored dates are naive UTC
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+
+class FetchLatestActionSchema(BaseModel):
+    group_ids: List[int] = Field(default_factory=list)
+    limit: int = Field(20, ge=1)
+
+
+class AttachmentOutSchema(BaseModel):
+    id: int
+    sha256: str
+    size: int
+    content_type: str
+    filename: str
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,38 @@
+import hashlib
+from fastapi import Request, Response
+from sqlalchemy import func
+from mysite.config import CACHE_CONTROL
+
+
+def make_etag(*parts) -> str:
+    raw = ':'.join(str(p) for p in parts)
+    return 'W/"%s"' % hashlib.md5(raw.encode()).hexdigest()
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = {t.strip().removeprefix('W/') for t in header.split(',')}
+    return etag.removeprefix('W/') in tags
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
+
+
+def set_cache_headers(response: Response, etag: str) -> None:
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = CACHE_CONTROL
+
+
+def stats_columns(model) -> tuple:
+    return func.count(model.id), func.max(model.id), func.max(model.updated_date)
+
+
+def rows_stats(rows) -> tuple:
+    if not rows:
+        return 0, None, None
+    return len(rows), max(r.id for r in rows), max(r.updated_date for r in rows)
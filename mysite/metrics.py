@@ -0,0 +1,98 @@
+import time
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.registry import REGISTRY
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from mysite.cache import response_cache
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency',
+                            ['method', 'route'])
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ['method', 'route', 'status'])
+
+WS_ACTION_LATENCY = Histogram('ws_action_duration_seconds', 'WebSocket action latency', ['action'])
+WS_ACTION_ERRORS = Counter('ws_action_errors_total', 'WebSocket actions answered with an error', ['action'])
+WS_CONNECTIONS = Gauge('ws_connections', 'Open WebSocket connections')
+WS_USERS = Gauge('ws_connected_users', 'Users with at least one open WebSocket')
+WS_REJECTED = Counter('ws_connections_rejected_total', 'WebSocket connections turned away', ['reason'])
+WS_REAPED = Counter('ws_connections_reaped_total', 'WebSockets closed for missing heartbeats')
+WS_OFFLINE_USERS = Gauge('ws_offline_users', 'Offline users holding undelivered message digests')
+
+BROADCAST_RECIPIENTS = Histogram('ws_broadcast_recipients', 'Sockets reached per broadcast',
+                                 buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+BROADCAST_DURATION = Histogram('ws_broadcast_duration_seconds', 'Broadcast fan-out duration')
+
+WS_BATCH_SIZE = Histogram('ws_batch_events', 'Events coalesced into one outbound frame',
+                          buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'SQL statement execution time',
+                              buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+
+class MetricsMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            REQUEST_LATENCY.labels(scope['method'], path).observe(time.perf_counter() - started)
+            REQUESTS.labels(scope['method'], path, str(status)).inc()
+
+
+class ResponseCacheCollector:
+    def collect(self):
+        hits = CounterMetricFamily('response_cache_hits', 'Response cache hits', labels=['route'])
+        misses = CounterMetricFamily('response_cache_misses', 'Response cache misses', labels=['route'])
+        for route, stats in response_cache.stats().items():
+            hits.add_metric([route], stats['hits'])
+            misses.add_metric([route], stats['misses'])
+        yield hits
+        yield misses
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    DB_QUERY_DURATION.observe(time.perf_counter() - conn.info['query_started'].pop())
+
+
+def _handle_error(context) -> None:
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def instrument_engine(engine: Engine) -> None:
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def observe_ws_action(action: str, started: float) -> None:
+    WS_ACTION_LATENCY.labels(action).observe(time.perf_counter() - started)
+
+
+def observe_broadcast(recipients: int, started: float) -> None:
+    BROADCAST_RECIPIENTS.observe(recipients)
+    BROADCAST_DURATION.observe(time.perf_counter() - started)
+
+
+REGISTRY.register(ResponseCacheCollector())
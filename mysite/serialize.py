@@ -0,0 +1,30 @@
+from functools import lru_cache
+from typing import Any, Iterable, List, Type
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
+
+
+@lru_cache(maxsize=None)
+def list_adapter(schema: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[schema])
+
+
+def schema_columns(model, schema: Type[BaseModel], *extra) -> tuple:
+    # only the columns the response schema exposes, plus extras such as updated_date for etags
+    return tuple(getattr(model, name) for name in schema.model_fields) + extra
+
+
+def dump_rows(schema: Type[BaseModel], rows: Iterable[Any]) -> List[dict]:
+    # column rows come straight from typed columns, so they skip per-row model validation;
+    # orjson encodes the datetimes and enums when the response is rendered
+    fields = tuple(schema.model_fields)
+    return [{name: getattr(row, name) for name in fields} for row in rows]
+
+
+def dump_objects(schema: Type[BaseModel], objects: Iterable[Any]) -> List[dict]:
+    adapter = list_adapter(schema)
+    return adapter.dump_python(adapter.validate_python(list(objects), from_attributes=True), mode='json')
+
+
+def rows_response(schema: Type[BaseModel], rows: Iterable[Any]) -> ORJSONResponse:
+    return ORJSONResponse(dump_rows(schema, rows))
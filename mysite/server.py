@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import os
+import socket
+from typing import Awaitable, Callable, List, Optional, Union
+import uvicorn
+from uvicorn.importer import import_from_string
+from uvicorn.supervisors import Multiprocess
+from mysite.config import (SERVER_APP, SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_LOOP, SERVER_HTTP,
+                           SERVER_BACKLOG, SERVER_KEEPALIVE, SERVER_GRACEFUL_TIMEOUT, WS_PING_INTERVAL,
+                           WS_PING_TIMEOUT, BUS_URL)
+
+# resolved inside each worker, so the server object stays picklable for spawned workers
+DRAIN = 'mysite.api.chat_wb:manager.drain'
+
+
+class DrainingServer(uvicorn.Server):
+    # uvicorn closes every websocket at once on shutdown; stop listening first and let
+    # `drain` move the clients off gradually, then continue with the normal shutdown
+    def __init__(self, config: uvicorn.Config, drain: Union[str, Callable[[], Awaitable[None]]] = DRAIN) -> None:
+        super().__init__(config)
+        self.drain = drain
+
+    async def shutdown(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+
+        drain_fn = import_from_string(self.drain) if isinstance(self.drain, str) else self.drain
+        drain = asyncio.ensure_future(drain_fn())
+        while not drain.done() and not self.force_exit:
+            await asyncio.sleep(0.1)
+        drain.cancel()
+        await super().shutdown(sockets)
+
+
+def build_config(args: argparse.Namespace) -> uvicorn.Config:
+    workers = args.workers or os.cpu_count() or 1
+    return uvicorn.Config(
+        args.app,
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=args.loop,
+        http=args.http,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        ws_ping_interval=args.ws_ping_interval,
+        ws_ping_timeout=args.ws_ping_timeout,
+        proxy_headers=args.proxy_headers,
+        lifespan='on',
+    )
+
+
+def serve(config: uvicorn.Config) -> None:
+    server = DrainingServer(config)
+    if config.workers > 1:
+        sock = config.bind_socket()
+        Multiprocess(config, target=server.run, sockets=[sock]).run()
+    else:
+        server.run()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Run the chat API in production')
+    parser.add_argument('--app', default=SERVER_APP, help='ASGI app as module:attribute')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help='worker processes, 0 for one per CPU; more than one needs BUS_URL so the '
+                             'workers share broadcasts, rooms, presence and cache invalidation')
+    parser.add_argument('--loop', default=SERVER_LOOP, choices=['auto', 'asyncio', 'uvloop'],
+                        help='auto picks uvloop when it is installed')
+    parser.add_argument('--http', default=SERVER_HTTP, choices=['auto', 'h11', 'httptools'],
+                        help='auto picks httptools when it is installed')
+    parser.add_argument('--backlog', type=int, default=SERVER_BACKLOG,
+                        help='pending connections the listening socket queues')
+    parser.add_argument('--keep-alive', type=int, default=SERVER_KEEPALIVE,
+                        help='seconds an idle HTTP keep-alive connection stays open')
+    parser.add_argument('--graceful-timeout', type=int, default=SERVER_GRACEFUL_TIMEOUT,
+                        help='seconds to wait for open requests after the WebSocket drain')
+    parser.add_argument('--ws-ping-interval', type=float, default=WS_PING_INTERVAL,
+                        help='seconds between protocol-level pings; these keep every client honest, '
+                             'the app heartbeat only covers clients that opt in')
+    parser.add_argument('--ws-ping-timeout', type=float, default=WS_PING_TIMEOUT,
+                        help='seconds to wait for a pong before the socket is closed')
+    parser.add_argument('--proxy-headers', action='store_true',
+                        help='trust X-Forwarded-* from the load balancer')
+    config = build_config(parser.parse_args(argv))
+    if config.workers > 1 and not BUS_URL:
+        parser.error(f'{config.workers} workers need BUS_URL; without it each worker only sees its own '
+                     'sockets and caches')
+    serve(config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'test-secret-key-that-is-long-enough')
+os.environ.setdefault('ARCHIVE_DIR', tempfile.mkdtemp(prefix='chat_archive_'))
+os.environ.setdefault('ATTACHMENT_DIR', tempfile.mkdtemp(prefix='chat_attachments_'))
+# the lifespan would otherwise try to open connections to the configured postgres
+os.environ.setdefault('DB_POOL_PREWARM', '0')
+
+from mysite.cache import LRUBackend, response_cache, member_cache, recent_messages
+from mysite.database import db as database
+from mysite.database.models import Base
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # a file database: ws actions query from worker threads, each on its own connection
+    engine = create_engine(f'sqlite:///{tmp_path / "chat.db"}', connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', lambda conn, record: conn.execute('PRAGMA foreign_keys=ON'))
+    database.SessionLocal.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def cold_caches(monkeypatch):
+    # every test starts cold, so a cached response cannot hide the queries behind it
+    monkeypatch.setattr(response_cache, 'backend', LRUBackend(100))
+    member_cache.invalidate()
+    recent_messages.invalidate()
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from mysite.database import db as database
+from mysite.database.archive import archive_group, message_archive
+from mysite.database.models import UserProfile, ChatGroup, GroupPeople, ChatMessage
+import main
+
+
+@pytest.fixture
+def group(engine, cold_caches):
+    db = database.SessionLocal()
+    user = UserProfile(username='alice', email='alice@example.com', password='pw')
+    db.add(user)
+    db.flush()
+    old = datetime.utcnow() - timedelta(days=200)
+    group = ChatGroup(owner_id=user.id, name='general', create_date=old)
+    db.add(group)
+    db.flush()
+    db.add(GroupPeople(group_id=group.id, user_id=user.id))
+    # the third row has a low id but a recent date, e.g. an imported or clock-skewed row
+    dates = [old, old, datetime.utcnow(), old, datetime.utcnow()]
+    db.add_all(ChatMessage(group_id=group.id, user_id=user.id, text=f'm{i}', created_date=d)
+               for i, d in enumerate(dates))
+    db.commit()
+    group_id = group.id
+    db.close()
+    yield group_id
+    message_archive.drop_group(group_id)
+
+
+def message_texts(group_id: int) -> list:
+    db = database.SessionLocal()
+    try:
+        return [m.text for m in db.query(ChatMessage).filter(ChatMessage.group_id == group_id)
+                .order_by(ChatMessage.id)]
+    finally:
+        db.close()
+
+
+def test_archive_deletes_only_archived_rows(group):
+    db = database.SessionLocal()
+    try:
+        assert archive_group(db, group, datetime.utcnow() - timedelta(days=90)) == 2
+        # the recent row stops the run; nothing after it is archived yet
+        assert archive_group(db, group, datetime.utcnow() - timedelta(days=90)) == 0
+    finally:
+        db.close()
+
+    assert [r['text'] for r in message_archive.read_before(group, None, 10)] == ['m0', 'm1']
+    assert message_texts(group) == ['m2', 'm3', 'm4']
+
+
+def test_group_detail_reads_archive_only_past_the_boundary(group, monkeypatch):
+    db = database.SessionLocal()
+    try:
+        archive_group(db, group, datetime.utcnow() - timedelta(days=90))
+    finally:
+        db.close()
+    boundary = message_archive.boundary(group)
+
+    reads = []
+    read_before = message_archive.read_before
+    monkeypatch.setattr(message_archive, 'read_before', lambda *a: reads.append(a) or read_before(*a))
+    client = TestClient(main.chat_app)
+
+    detail = client.get(f'/group/{group}').json()
+    assert [m['text'] for m in detail['messages']] == ['m2', 'm3', 'm4']
+    assert detail['archived_until'] == boundary
+    page = client.get(f'/group/{group}', params={'limit': 2, 'before_id': detail['messages'][-1]['id']}).json()
+    assert [m['text'] for m in page['messages']] == ['m2', 'm3']
+    assert reads == []
+
+    page = client.get(f'/group/{group}', params={'limit': 5, 'before_id': detail['messages'][0]['id']}).json()
+    assert [m['text'] for m in page['messages']] == ['m0', 'm1']
+    assert len(reads) == 1
+
+
+@pytest.mark.parametrize('path', ['/user/{user_id}?current_user_id={user_id}', '/auth/?user_id={user_id}'])
+def test_user_delete_drops_owned_archives(group, path):
+    db = database.SessionLocal()
+    try:
+        archive_group(db, group, datetime.utcnow() - timedelta(days=90))
+        owner_id = db.query(ChatGroup.owner_id).filter(ChatGroup.id == group).scalar()
+    finally:
+        db.close()
+    assert message_archive.segments(group)
+
+    response = TestClient(main.chat_app).delete(path.format(user_id=owner_id))
+    assert response.status_code == 200, response.text
+    assert message_archive.segments(group) == []
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from mysite.cache import RedisBackend, response_cache
+from mysite.database import db as database
+from mysite.database.models import UserProfile
+import main
+
+# nothing listens on port 1, so every call fails to connect
+DOWN_URL = 'redis://127.0.0.1:1/0'
+
+
+def test_redis_backend_fails_open():
+    async def run():
+        backend = RedisBackend(DOWN_URL)
+        assert await backend.get('cache:user_detail:1') is None
+        await backend.set('cache:user_detail:1', {'etag': 'x', 'content': {}}, 30)
+        await backend.delete('cache:user_detail:1')
+        await backend.delete_prefix('cache:group_list')
+
+    asyncio.run(run())
+
+
+def test_endpoints_work_while_redis_is_down(engine, cold_caches, monkeypatch):
+    db = database.SessionLocal()
+    user = UserProfile(username='alice', email='alice@example.com', password='pw')
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    db.close()
+    monkeypatch.setattr(response_cache, 'backend', RedisBackend(DOWN_URL))
+
+    client = TestClient(main.chat_app)
+    assert client.get(f'/user/{user_id}').json()['username'] == 'alice'
+    assert client.get('/group/').status_code == 200
+    response = client.delete(f'/user/{user_id}', params={'current_user_id': user_id})
+    assert response.status_code == 200, response.text
@@ -0,0 +1,96 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import InvalidRequestError
+
+from mysite.database import db as database
+from mysite.database.db import assert_max_queries
+from mysite.database.models import UserProfile, ChatGroup, GroupPeople, ChatMessage
+import main
+
+USERS = 3
+GROUPS = 4
+MESSAGES = 5
+
+
+@pytest.fixture
+def seeded(engine):
+    db = database.SessionLocal()
+    users = [UserProfile(username=f'user{i}', email=f'user{i}@example.com', password='pw') for i in range(USERS)]
+    db.add_all(users)
+    db.flush()
+    groups = [ChatGroup(owner_id=users[i % USERS].id, name=f'group{i}') for i in range(GROUPS)]
+    db.add_all(groups)
+    db.flush()
+    for group in groups:
+        db.add_all(GroupPeople(group_id=group.id, user_id=user.id) for user in users)
+        db.add_all(ChatMessage(group_id=group.id, user_id=users[i % USERS].id, text=f'message {i}')
+                   for i in range(MESSAGES))
+    db.commit()
+    ids = {'users': [u.id for u in users], 'groups': [g.id for g in groups]}
+    db.close()
+    return ids
+
+
+@pytest.fixture
+def client(seeded, cold_caches):
+    return TestClient(main.chat_app)
+
+
+def test_relationships_raise_instead_of_lazy_loading(seeded):
+    db = database.SessionLocal()
+    try:
+        group = db.query(ChatGroup).first()
+        user = db.query(UserProfile).first()
+        with pytest.raises(InvalidRequestError):
+            group.owner
+        with pytest.raises(InvalidRequestError):
+            user.user_groups
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize('path, limit', [
+    ('/user/', 1),
+    ('/user/{user_id}', 1),
+    ('/group/', 1),
+    ('/group/{group_id}', 3),
+    ('/group/{group_id}?limit=3', 4),
+    ('/group/owner/{user_id}', 2),
+    ('/people/', 1),
+    ('/people/group/{group_id}', 2),
+    ('/people/user/{user_id}', 2),
+])
+def test_reads_do_not_grow_with_rows(client, seeded, path, limit):
+    path = path.format(user_id=seeded['users'][0], group_id=seeded['groups'][0])
+    with assert_max_queries(limit, path):
+        response = client.get(path)
+    assert response.status_code == 200, response.text
+
+
+def test_group_delete(client, seeded):
+    group_id, owner_id = seeded['groups'][0], seeded['users'][0]
+    with assert_max_queries(4, 'group delete'):
+        response = client.delete(f'/group/{group_id}', params={'current_user_id': owner_id})
+    assert response.status_code == 200, response.text
+
+    db = database.SessionLocal()
+    try:
+        assert db.query(GroupPeople).filter(GroupPeople.group_id == group_id).count() == 0
+        assert db.query(ChatMessage).filter(ChatMessage.group_id == group_id).count() == 0
+    finally:
+        db.close()
+
+
+def test_user_delete(client, seeded):
+    user_id = seeded['users'][0]
+    with assert_max_queries(3, 'user delete'):
+        response = client.delete(f'/user/{user_id}', params={'current_user_id': user_id})
+    assert response.status_code == 200, response.text
+
+    db = database.SessionLocal()
+    try:
+        assert db.query(ChatGroup).filter(ChatGroup.owner_id == user_id).count() == 0
+        assert db.query(GroupPeople).filter(GroupPeople.user_id == user_id).count() == 0
+        assert db.query(ChatMessage).filter(ChatMessage.user_id == user_id).count() == 0
+    finally:
+        db.close()
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+from fastapi import WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+from mysite.api import chat_wb
+from mysite.api.auth import create_access_token
+from mysite.cache import member_cache, recent_messages
+from mysite.database import db as database
+from mysite.database.db import assert_max_queries
+from mysite.database.models import UserProfile, ChatGroup, GroupPeople, ChatMessage
+import main
+
+
+@pytest.fixture
+def chat(engine, cold_caches):
+    db = database.SessionLocal()
+    alice = UserProfile(username='alice', email='alice@example.com', password='pw')
+    bob = UserProfile(username='bob', email='bob@example.com', password='pw')
+    db.add_all([alice, bob])
+    db.flush()
+    group = ChatGroup(owner_id=alice.id, name='general')
+    db.add(group)
+    db.flush()
+    db.add_all([GroupPeople(group_id=group.id, user_id=alice.id), GroupPeople(group_id=group.id, user_id=bob.id)])
+    db.add(ChatMessage(group_id=group.id, user_id=bob.id, text='hello'))
+    db.commit()
+    ids = {'alice': alice.id, 'bob': bob.id, 'group': group.id}
+    db.close()
+    with TestClient(main.chat_app) as client:
+        yield client, ids
+    for user_id in (ids['alice'], ids['bob']):
+        chat_wb.offline_queue.take(user_id)
+
+
+def ws_url(username: str) -> str:
+    return f'/ws/chat?token={create_access_token({"sub": username})}'
+
+
+def receive_until(ws, event: str) -> list:
+    events = [ws.receive_json()]
+    while events[-1]['event'] != event:
+        events.append(ws.receive_json())
+    return events
+
+
+def test_send_message_survives_sender_disconnect(chat, monkeypatch):
+    client, ids = chat
+    send = chat_wb._send_message
+
+    def slow_send(*args):
+        # the sender is gone before the row is committed
+        time.sleep(0.3)
+        return send(*args)
+
+    with client.websocket_connect(ws_url('bob')) as bob:
+        assert bob.receive_json()['event'] == 'connected'
+        bob.send_json({'action': 'fetch_messages', 'group_id': ids['group']})
+        assert [m['text'] for m in receive_until(bob, 'messages')[-1]['items']] == ['hello']
+        assert recent_messages.buffered(ids['group'])
+
+        monkeypatch.setattr(chat_wb, '_send_message', slow_send)
+        with client.websocket_connect(ws_url('alice')) as alice:
+            assert alice.receive_json()['event'] == 'connected'
+            alice.send_json({'action': 'send_message', 'group_id': ids['group'], 'text': 'bye'})
+
+        time.sleep(0.6)
+        bob.send_json({'action': 'fetch_messages', 'group_id': ids['group']})
+        events = receive_until(bob, 'messages')
+
+    assert [e['message']['text'] for e in events if e['event'] == 'message'] == ['bye']
+    assert [m['text'] for m in events[-1]['items']] == ['hello', 'bye']
+
+
+def test_app_heartbeat_is_opt_in(chat, monkeypatch):
+    client, ids = chat
+    monkeypatch.setattr(chat_wb.manager, 'heartbeat_interval', 0.05)
+    monkeypatch.setattr(chat_wb.manager, 'heartbeat_timeout', 0.2)
+
+    with client.websocket_connect(ws_url('bob')) as bob:
+        assert bob.receive_json()['heartbeat_ms'] == 0
+
+        with client.websocket_connect(ws_url('alice'), subprotocols=['heartbeat']) as alice:
+            assert alice.accepted_subprotocol == 'heartbeat'
+            assert alice.receive_json()['heartbeat_ms'] == 50
+            assert receive_until(alice, 'ping')[-1] == {'event': 'ping'}
+            # alice stops answering and is reaped
+            with pytest.raises(WebSocketDisconnect) as closed:
+                while True:
+                    alice.receive_json()
+            assert closed.value.code == 1001
+
+        # bob never opted in: no pings, and still connected well past the timeout
+        bob.send_json({'action': 'fetch_messages', 'group_id': ids['group'], 'request_id': 1})
+        assert receive_until(bob, 'messages')[0]['event'] == 'messages'
+
+
+def test_broadcast_never_queries_membership(chat, monkeypatch):
+    client, ids = chat
+    with client.websocket_connect(ws_url('bob')) as bob:
+        assert bob.receive_json()['event'] == 'connected'
+        # connecting warmed the cache for bob's groups
+        assert member_cache.get(ids['group']) == {ids['alice'], ids['bob']}
+
+        member_cache.invalidate(ids['group'])
+        refreshed = []
+        monkeypatch.setattr(chat_wb, 'refresh_members', refreshed.append)
+        with assert_max_queries(0, 'broadcast'):
+            reached = client.portal.call(chat_wb.manager.broadcast_to_group, ids['group'], {'event': 'hi'})
+
+        # the room stood in for the cold cache, and a refresh was handed off
+        assert reached == {ids['bob']}
+        assert refreshed == [ids['group']]
+        assert receive_until(bob, 'hi') == [{'event': 'hi'}]